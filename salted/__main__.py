@@ -8,11 +8,15 @@ Source: https://github.com/RuedigerVoigt/salted
 (c) 2020-2021: Released under the Apache License 2.0
 """
 
-from collections import Counter
+import asyncio
+import concurrent.futures
 import configparser
-import datetime
+import functools
 import logging
+import os
 import pathlib
+import stat
+import sys
 import time
 from typing import Optional, Union
 
@@ -29,6 +33,30 @@ from salted import memory_instance
 from salted import url_check
 from salted import report_generator
 
+# uvloop is an optional and faster drop-in replacement for the event loop
+# of asyncio. It is not available for Windows.
+if sys.platform != 'win32':
+    try:
+        import uvloop  # type: ignore
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+# Format of the timestamp in reports:
+_TIMESTAMP_FORMAT = '%Y-%b-%d %H:%Mh'
+
+
+@functools.lru_cache(maxsize=4)
+def _load_config(path: str,
+                 mtime: float) -> configparser.ConfigParser:
+    """Parse the configfile once per process. The modification time is part
+       of the cache key, so a changed file is parsed again.
+       The returned object is shared between calls and must not be changed."""
+    # pylint: disable=unused-argument
+    cfg = configparser.ConfigParser()
+    cfg.read(path)
+    return cfg
+
 
 class Salted:
     """Main class. Creates the other Objects, starts workers,
@@ -40,33 +68,38 @@ class Salted:
     VERSION = version.__version__
     CONFIG_NAME = 'salted-linkcheck.ini'
 
+    # Fixed set of settings: no per instance __dict__ and a typo in the
+    # name of a setting raises an AttributeError instead of being ignored.
+    __slots__ = (
+        'searchpath', 'file_types', 'max_file_size_mb',
+        'num_workers', 'timeout', 'raise_for_dead_links', 'user_agent',
+        'ignore_urls', 'use_processes',
+        'cache_file', 'dont_check_again_within_hours',
+        'template_searchpath', 'template_name', 'write_to', 'base_url')
+
+    # The environment does not change while the process runs. So the
+    # compatibility check runs only for the first instance.
+    _compatibility_checked = False
+
     def __init__(self) -> None:
 
-        compatibility.Check(
-            package_name='salted',
-            package_version=self.VERSION,
-            release_date=version.release_date,
-            python_version_support={
-                'min_version': '3.8',
-                'incompatible_versions': ['3.6', '3.7'],
-                'max_tested_version': '3.9'},
-            nag_over_update={
-                    'nag_days_after_release': 60,
-                    'nag_in_hundred': 100},
-            language_messages='en',
-            system_support={'full': {'Linux', 'MacOS', 'Windows'}}
-            )
+        self._ensure_env()
 
         # #################### Application defaults ####################
         # Files
         self.searchpath: Union[str, pathlib.Path] = pathlib.Path.cwd()
         self.file_types: str = 'supported'
+        # Larger files are skipped with a warning:
+        self.max_file_size_mb: int = 10
         # Behavior
         self.num_workers: Union[int, str] = 'automatic'
         self.timeout: int = 5
         self.raise_for_dead_links = False
         self.user_agent = f"salted/{self.VERSION}"
         self.ignore_urls: set = set()
+        # Scan files with one process per core. Needs the main guard
+        # (if __name__ == '__main__') in scripts that call check:
+        self.use_processes = False
         # Cache
         self.cache_file: Union[pathlib.Path, str] = 'salted-cache.sqlite3'
         self.dont_check_again_within_hours: int = 24
@@ -79,16 +112,39 @@ class Salted:
         # If there is a configfile, overwrite defaults with those settings
         self.__parse_configfile()
 
-        self.cnt: Counter = Counter()
+    @classmethod
+    def _ensure_env(cls) -> None:
+        """Check the Python version and the operating system once per
+           process and warn about incompatible or untested versions."""
+        if cls._compatibility_checked:
+            return
+        compatibility.Check(
+            package_name='salted',
+            package_version=cls.VERSION,
+            release_date=version.release_date,
+            python_version_support={
+                'min_version': '3.8',
+                'incompatible_versions': ['3.6', '3.7'],
+                'max_tested_version': '3.9'},
+            nag_over_update={
+                    'nag_days_after_release': 60,
+                    'nag_in_hundred': 100},
+            language_messages='en',
+            system_support={'full': {'Linux', 'MacOS', 'Windows'}}
+            )
+        cls._compatibility_checked = True
 
     def __parse_configfile(self) -> None:
         """If there is a configfile read it and overwrite defaults if new
            value is set for them. If a specific parameter is not set,
            fall back to the application default.
            Config file settings can be overwritten trough CLI parameters."""
-        cfg = configparser.ConfigParser()
-        # read does not throw an exception if the file is not there!
-        cfg.read(self.CONFIG_NAME)
+        if not os.path.exists(self.CONFIG_NAME):
+            return
+        # The name is relative to the working directory, which can change
+        # between instances. So the absolute path is part of the cache key.
+        config_path = os.path.abspath(self.CONFIG_NAME)
+        cfg = _load_config(config_path, os.path.getmtime(config_path))
         for section in cfg.sections():
             if section not in {'BEHAVIOR', 'CACHE', 'FILES', 'TEMPLATE'}:
                 raise ValueError('Configfile contains unknown section!')
@@ -103,6 +159,9 @@ class Salted:
             self.user_agent = behavior.get('user_agent', self.user_agent)
             if behavior.get('ignore_urls'):
                 self.ignore_urls = set(behavior.get('ignore_urls').split(','))
+            self.use_processes = behavior.getboolean(
+                        'use_processes',
+                        self.use_processes)
         if 'CACHE' in cfg.sections():
             cache = cfg['CACHE']
             self.cache_file = cache.get('cache_file', self.cache_file)  # type: ignore[arg-type]
@@ -113,6 +172,9 @@ class Salted:
             files = cfg['FILES']
             self.searchpath = files.get('searchpath', self.searchpath)  # type: ignore[arg-type]
             self.file_types = files.get('file_types', self.file_types)
+            self.max_file_size_mb = files.getint(
+                        'max_file_size_mb',
+                        self.max_file_size_mb)
         if 'TEMPLATE' in cfg.sections():
             template = cfg['TEMPLATE']
             self.template_searchpath = template.get(
@@ -127,56 +189,81 @@ class Salted:
         if self.base_url:
             self.base_url = self.base_url.rstrip('/')
 
+    @staticmethod
+    async def __run_checks(checks: list) -> None:
+        """Run the URL and the DOI check concurrently within one event loop.
+           Both write through the same DatabaseIO cursor and its buffers.
+           This is only safe as both run as coroutines in this thread:
+           do not move either of them into another thread or process."""
+        await asyncio.gather(*checks)
+
+    @staticmethod
+    async def __check_dois(dois: doi_check.DoiCheck) -> None:
+        "Check the DOIs and close the session to the API afterwards."
+        async with dois:
+            await dois.check_dois_async()
+
     def check(self,
               searchpath: Union[str, pathlib.Path]) -> None:
         """Check all links and DOIs found in a specific file or in all supported
            files within the provided folder and its subfolders."""
         start_time = time.monotonic()
-
-        # check might be reused with the same salted object. Therefore
-        # the in memory database has to initialized here instead of on
-        # a higher level.
-        mem_instance = memory_instance.MemoryInstance()
-        db = database_io.DatabaseIO(mem_instance, self.cache_file)
-
-        cache_handler = cache_reader.CacheReader(
-            mem_instance,
-            self.dont_check_again_within_hours,
-            self.cache_file)
-
-        cache_handler.load_disk_cache()
+        # Wall clock time for the report. Not used to measure the runtime.
+        start_wall = time.time()
 
         # Expand path as otherwise a relative path will not be rewritten
         # in output:
         path = pathlib.Path(searchpath).resolve()
+        path_str = str(path)
 
-        if not path.exists():
+        # A single stat call instead of one for exists, is_dir and is_file.
+        # A file in place of a folder within the path means it does not
+        # exist, too. Other errors (like missing permissions) propagate:
+        try:
+            path_mode = os.stat(path).st_mode
+        except (FileNotFoundError, NotADirectoryError):
             msg = f"File or folder to check ({path}) does not exist."
             logging.exception(msg)
-            raise FileNotFoundError(msg)
+            raise FileNotFoundError(msg) from None
 
         filesearch = file_finder.FileFinder()
-        file_io = input_handler.InputHandler(db)
         files_to_check = list()
-        if path.is_dir():
+        if stat.S_ISDIR(path_mode):
             logging.info('Base folder: %s', path)
             files_to_check = filesearch.find_files_by_extensions(path)
-            if files_to_check:
-                file_io.scan_files(files_to_check)
-                mem_instance.generate_indices()
-                db.del_links_that_can_be_skipped()
-                db.del_dois_that_can_be_skipped()
-            else:
+            if not files_to_check:
                 logging.warning(
                     "No supported files in this folder or its subfolders.")
                 return
-        elif path.is_file() and filesearch.is_supported_format(path):
+        elif stat.S_ISREG(path_mode) and filesearch.is_supported_format(path):
             files_to_check.append(path)
         else:
             msg = f"File format of {path} not supported"
             logging.exception(msg)
             raise ValueError(msg)
 
+        # check might be reused with the same salted object. Therefore
+        # the in memory database has to initialized here instead of on
+        # a higher level. This happens only once it is known that there
+        # are files to check, so a run without any does not read the cache.
+        mem_instance = memory_instance.MemoryInstance()
+        db = database_io.DatabaseIO(mem_instance)
+
+        cache_handler = cache_reader.CacheReader(
+            mem_instance,
+            self.dont_check_again_within_hours,
+            self.cache_file)
+
+        cache_handler.load_disk_cache()
+
+        file_io = input_handler.InputHandler(
+            db, int(self.max_file_size_mb) << 20, self.use_processes)
+
+        # One transaction instead of one per statement:
+        with db.transaction():
+            file_io.scan_files(files_to_check)
+            db.prepare_for_checks()
+
         # ##### START CHECKS #####
 
         urls = url_check.UrlCheck(
@@ -185,15 +272,29 @@ class Salted:
             self.num_workers,
             self.timeout,
             self.ignore_urls)
-        urls.check_urls()
-
-        doi = doi_check.DoiCheck(db)
-        doi.check_dois()
+        # Only start the event loop and create sessions for checks that
+        # have something to do.
+        checks = list()
+        if db.has_urls_to_check():
+            checks.append(urls.check_urls_async())
+        if db.has_dois_to_check():
+            checks.append(self.__check_dois(doi_check.DoiCheck(db)))
+        if checks:
+            asyncio.run(self.__run_checks(checks))
 
         # ##### END CHECKS #####
 
         mem_instance.generate_db_views()
 
+        # Write the cache file in a background thread while the report is
+        # generated. SQLite releases the GIL while writing, so this overlaps
+        # with rendering the report. The in-memory database is only used
+        # by this thread: the snapshot is taken here and the writer gets
+        # nothing but the snapshot.
+        cache_handler.take_snapshot()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        cache_writer = executor.submit(cache_handler.write_snapshot)
+
         runtime_check = time.monotonic() - start_time
 
         # Although time.monotonic() works with fractional seconds,
@@ -203,31 +304,43 @@ class Salted:
         runtime_check = 1 if runtime_check == 0 else runtime_check
         # TO DO: check why this happens on Windows
 
-        display_result = report_generator.ReportGenerator(mem_instance)
-
-        display_result.generate_report(
-            statistics={
-                'timestamp': '{:%Y-%b-%d %H:%Mh}'.format(datetime.datetime.now()),
-                'num_links': file_io.cnt['links_found'],
-                'num_checked': urls.cnt['checked_urls'],
-                'time_to_check': (round(runtime_check)),
-                'checks_per_second': (
-                    round(urls.cnt['checked_urls'] / runtime_check, 2)),
-                'num_fine': urls.cnt['fine'],
-                'needed_full_request': urls.cnt['neededFullRequest']
-                          },
-            template={
-                'searchpath': self.template_searchpath,
-                'name': self.template_name,
-                'foldername_to_replace': str(path),
-                'base_url': self.base_url},
-            write_to=self.write_to,
-            replace_path_by_url={
-                'path_to_be_replaced': str(path),
-                'replace_with_url': self.base_url
-            })
+        # The cache file is written even if the report fails:
+        try:
+            display_result = report_generator.ReportGenerator(mem_instance)
+
+            display_result.generate_report(
+                statistics={
+                    'timestamp': time.strftime(_TIMESTAMP_FORMAT,
+                                               time.localtime(start_wall)),
+                    'num_links': file_io.cnt['links_found'],
+                    'num_checked': urls.cnt['checked_urls'],
+                    'time_to_check': (round(runtime_check)),
+                    'checks_per_second': (
+                        round(urls.cnt['checked_urls'] / runtime_check, 2)),
+                    'num_fine': urls.cnt['fine'],
+                    'needed_full_request': urls.cnt['neededFullRequest']
+                              },
+                template={
+                    'searchpath': self.template_searchpath,
+                    'name': self.template_name,
+                    'foldername_to_replace': path_str,
+                    'base_url': self.base_url},
+                write_to=self.write_to,
+                replace_path_by_url={
+                    'path_to_be_replaced': path_str,
+                    'replace_with_url': self.base_url
+                })
+        finally:
+            try:
+                # Wait for the cache file. This re-raises exceptions of the
+                # thread.
+                if not cache_writer.result():
+                    # Could not add the new entries to the existing file:
+                    cache_handler.rewrite_cache_file()
+            finally:
+                executor.shutdown()
+
         if self.raise_for_dead_links:
             if db.count_errors() > 0:
                 raise err.DeadLinksException("Found dead URLs")
-        cache_handler.overwrite_cache_file()
         mem_instance.tear_down_in_memory_db()
@@ -10,9 +10,11 @@ Released under the Apache License 2.0
 """
 
 import logging
+import os
 import pathlib
 import sqlite3
-from typing import Optional, Union
+import time
+from typing import Dict, Optional, Tuple, Union
 
 from salted import memory_instance
 
@@ -20,12 +22,41 @@ from salted import memory_instance
 class CacheReader:
     """Handle the cache file"""
 
+    # The connection caches compiled statements keyed by their SQL text.
+    # Keeping the text in constants makes sure every call hits that cache.
+    _SQL_LOAD_URLS = '''
+        INSERT INTO validUrls
+        (normalizedUrl, lastValid)
+        SELECT normalizedUrl, lastValid
+        FROM diskcache.validUrls
+        WHERE lastValid > ?;'''
+    # Older versions kept the spelling of the files. Lowercase those DOIs
+    # and keep only one row if several spellings were cached:
+    _SQL_LOAD_DOIS = '''
+        INSERT INTO validDois (doi, lastSeen)
+        SELECT lower(doi), MAX(lastSeen) FROM diskcache.validDois
+        GROUP BY lower(doi);'''
+    # Rows added after the cache was loaded:
+    _SQL_NEW_URLS = '''
+        SELECT normalizedUrl, lastValid FROM validUrls
+        WHERE rowid > ?;'''
+    _SQL_NEW_DOIS = '''
+        SELECT doi, lastSeen FROM validDois
+        WHERE rowid > ?;'''
+
     def __init__(self,
                  mem_instance: memory_instance.MemoryInstance,
                  dont_check_again_within_hours: int,
                  cache_file: Union[pathlib.Path, str] = None) -> None:
 
         self.cache_file_path: Optional[pathlib.Path] = None
+        # Highest rowid per table after loading the cache file. Rows above
+        # are new in this run. None if the cache file was not loaded.
+        self.loaded_rowids: Optional[Dict[str, int]] = None
+        # Snapshot for write_snapshot: either the rows new in this run
+        # (URLs, DOIs) or a copy of the whole in-memory database.
+        self.new_rows: Optional[Tuple[list, list]] = None
+        self.database_copy: Optional[sqlite3.Connection] = None
 
         if not cache_file:
             logging.debug('No path to cache file provided.')
@@ -63,57 +94,172 @@ class CacheReader:
                              'but must include file name!')
 
     def load_disk_cache(self) -> None:
-        """If there is a cache file open it, read the valid URLs and
-           load them into the in-memory instance of sqlite."""
+        """If there is a cache file, attach it to the in-memory instance of
+           sqlite and copy the valid URLs and DOIs. The rows are copied
+           within SQLite and never become Python objects."""
 
         if not self.cache_file_path:
             return
 
-        valid_urls = list()
-        valid_dois = list()
+        # ATTACH would create an empty file if there is none.
+        if not self.cache_file_path.is_file():
+            logging.debug('No cache file found.')
+            return
 
         try:
             logging.debug('Trying to load disk cache')
-            disk_cache = sqlite3.connect(
-                self.cache_file_path,
-                isolation_level=None  # reenable autocommit
-            )
-            disk_cache_cursor = disk_cache.cursor()
-            disk_cache_cursor.execute('''
-                SELECT
-                normalizedUrl, lastValid
-                FROM validUrls
-                WHERE lastValid > (strftime('%s','now') - (? * 3600));''',
-                [self.dont_check_again_within_hours])
-            valid_urls = disk_cache_cursor.fetchall()
-
-            disk_cache_cursor.execute('SELECT doi, lastSeen FROM validDois;')
-            valid_dois = disk_cache_cursor.fetchall()
-
-        except Exception:
-            logging.debug('No cache file or could not read it.', exc_info=True)
+            self.cursor.execute('ATTACH DATABASE ? AS diskcache;',
+                                [str(self.cache_file_path)])
+        except sqlite3.Error:
+            logging.debug('Could not open the cache file.', exc_info=True)
+            return
+
+        try:
+            # Read the cache through a memory map instead of read() calls:
+            self.cursor.executescript('''
+                PRAGMA diskcache.cache_size=-65536;
+                PRAGMA diskcache.mmap_size=268435456;''')
+            # Copy both tables within a single transaction:
+            self.cursor.execute('BEGIN;')
+            # A plain number lets SQLite use the index on lastValid:
+            cutoff = (int(time.time()) -
+                      self.dont_check_again_within_hours * 3600)
+            self.cursor.execute(self._SQL_LOAD_URLS, [cutoff])
+            self.cursor.execute(self._SQL_LOAD_DOIS)
+            self.cursor.execute('COMMIT;')
+            self.loaded_rowids = {
+                table: self.cursor.execute(
+                    f"SELECT IFNULL(MAX(rowid), 0) FROM {table};"
+                    ).fetchone()[0]
+                for table in ('validUrls', 'validDois')}
+        except sqlite3.Error:
+            logging.debug('Could not read the cache file.', exc_info=True)
+            if self.mem_instance.conn.in_transaction:
+                self.cursor.execute('ROLLBACK;')
         finally:
-            disk_cache.close()
+            self.cursor.execute('DETACH DATABASE diskcache;')
 
-        if valid_urls:
-            self.cursor.executemany('''
-                INSERT INTO validUrls
-                (normalizedUrl, lastValid)
-                VALUES (?, ?);''', valid_urls)
+    def overwrite_cache_file(self) -> None:
+        """Write the cache file. If the cache was loaded from that file,
+           only add the entries that are new in this run and remove expired
+           ones. Otherwise write the whole in-memory database into the file
+           and overwrite any file in the given path."""
+        self.take_snapshot()
+        if not self.write_snapshot():
+            self.rewrite_cache_file()
 
-        if valid_dois:
-            self.cursor.executemany(
-                'INSERT INTO validDois (doi, lastSeen) VALUES (?, ?);',
-                valid_dois)
+    def take_snapshot(self) -> None:
+        """Collect everything the cache file needs from the in-memory
+           database. Has to run in the thread that owns its connection.
+           Afterwards write_snapshot can run in another thread while this
+           one keeps using the connection."""
+        if not self.cache_file_path:
+            return
+        if self.loaded_rowids is not None and self.cache_file_path.is_file():
+            rowids = self.loaded_rowids
+            self.new_rows = (
+                self.cursor.execute(self._SQL_NEW_URLS,
+                                    [rowids['validUrls']]).fetchall(),
+                self.cursor.execute(self._SQL_NEW_DOIS,
+                                    [rowids['validDois']]).fetchall())
+        else:
+            self.__copy_database()
 
-    def overwrite_cache_file(self) -> None:
-        """Write the current in-memory database into a file.
-           Overwrite any file in the given path."""
+    def __copy_database(self) -> None:
+        """Copy the in-memory database into a second in-memory database.
+           That copy is handed over to the thread which writes the file, so
+           no connection is ever used by two threads at the same time. This
+           is safe even if SQLite was not compiled as fully thread-safe."""
+        self.new_rows = None
+        self.database_copy = sqlite3.connect(':memory:',
+                                             check_same_thread=False)
+        self.mem_instance.conn.backup(self.database_copy, pages=-1)
 
-        self.cache_file_path.unlink(missing_ok=True)  # type: ignore[union-attr]
+    def write_snapshot(self) -> bool:
+        """Write the snapshot into the cache file. Uses neither the
+           in-memory database nor its connection, so it can run in another
+           thread. Returns False if the new entries could not be added to
+           the existing file. In that case call rewrite_cache_file."""
+        if not self.cache_file_path:
+            return True
+        if self.new_rows is not None:
+            try:
+                self.__update_cache_file()
+                return True
+            except sqlite3.Error:
+                logging.debug('Could not update the cache file.',
+                              exc_info=True)
+                return False
+        self.__write_new_cache_file()
+        return True
 
-        if self.cache_file_path:
-            new_cache_file = sqlite3.connect(self.cache_file_path)
+    def rewrite_cache_file(self) -> None:
+        """Write the whole in-memory database into the cache file. Has to
+           run in the thread that owns the connection."""
+        self.__copy_database()
+        self.__write_new_cache_file()
+
+    def __update_cache_file(self) -> None:
+        """Add the entries new in this run to the existing cache file and
+           delete the expired ones within one transaction. This writes only
+           the changes instead of the whole database."""
+        if self.new_rows is None or self.cache_file_path is None:
+            raise RuntimeError('No snapshot of the new rows.')
+        new_urls, new_dois = self.new_rows
+        cutoff = int(time.time()) - self.dont_check_again_within_hours * 3600
+
+        cache_file = sqlite3.connect(self.cache_file_path)
+        try:
+            # Cache files of older versions were not written in WAL mode:
+            cache_file.executescript('''
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;''')
+            with cache_file:
+                # Cache files of older versions lack some indices:
+                memory_instance.MemoryInstance.create_cache_indices(
+                    cache_file)
+                cache_file.executemany('''
+                    INSERT INTO validUrls (normalizedUrl, lastValid)
+                    VALUES (?, ?);''', new_urls)
+                cache_file.executemany('''
+                    INSERT OR IGNORE INTO validDois (doi, lastSeen)
+                    VALUES (?, ?);''', new_dois)
+                cache_file.execute(
+                    'DELETE FROM validUrls WHERE lastValid <= ?;', [cutoff])
+            cache_file.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+        finally:
+            cache_file.close()
+        self.new_rows = None
+
+    def __write_new_cache_file(self) -> None:
+        "Write the copy of the in-memory database into a new cache file."
+        if self.cache_file_path is None or self.database_copy is None:
+            raise RuntimeError('No path to the cache file or no copy.')
+
+        # Write into a temporary file and then move it over the old cache
+        # file. So there is no time window without a valid cache file,
+        # even if the process gets killed while writing.
+        tmp_path = self.cache_file_path.with_suffix(
+            self.cache_file_path.suffix + '.tmp')
+        # Leftover of an interrupted run:
+        tmp_path.unlink(missing_ok=True)
+
+        new_cache_file = sqlite3.connect(tmp_path)
+        try:
+            # WAL with synchronous=NORMAL avoids a fsync per transaction:
+            new_cache_file.executescript('''
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;''')
             with new_cache_file:
-                self.mem_instance.conn.backup(new_cache_file, name='main')
+                # Copy all pages in a single step:
+                self.database_copy.backup(new_cache_file, pages=-1,
+                                          name='main')
+            # Move everything from the write-ahead log into the database
+            # file and truncate the log, so the cache is a single
+            # self-contained file.
+            new_cache_file.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+        finally:
             new_cache_file.close()
+            self.database_copy.close()
+            self.database_copy = None
+        os.replace(tmp_path, self.cache_file_path)
@@ -16,9 +16,33 @@ import pathlib
 import salted
 
 
+def _str_to_bool(value: str) -> bool:
+    "Convert the string value of a boolean command line argument."
+    if value in ("True", "true", "yes"):
+        return True
+    if value in ("False", "false", "no"):
+        return False
+    raise argparse.ArgumentTypeError(f"Unknown boolean value: {value}")
+
+
+def _positive_int(value: str) -> int:
+    "Convert a command line argument that must be larger than zero."
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"Must be at least 1: {value}")
+    return number
+
+
+def _non_negative_int(value: str) -> int:
+    "Convert a command line argument that must not be negative."
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"Must not be negative: {value}")
+    return number
+
+
 def main() -> None:
     "Provide an entrypoint for a command line interface of salted"
-    # pylint: disable=too-many-branches
 
     logging.debug('salted called via the CLI')
 
@@ -45,20 +69,25 @@ def main() -> None:
         "--file_types",
         choices=['supported', 'html', 'tex', 'markdown'],
         help="Choose which kind of files will be checked.")
+    parser.add_argument(
+        "--max_file_size_mb",
+        type=_positive_int,
+        help="Larger files are skipped with a warning (default: 10).",
+        metavar='<MiB>')
 
     parser.add_argument(
         "-w", "--num_workers",
-        type=int,
+        type=_positive_int,
         help="The number of workers to use in parallel (default: automatic)",
         metavar='<num>')
     parser.add_argument(
         "--timeout",
-        type=int,
+        type=_positive_int,
         help="Number of seconds to wait for an answer of a server (default: 5).",
         metavar='<seconds>')
     parser.add_argument(
         "--raise_for_dead_links",
-        type=str,
+        type=_str_to_bool,
         help="True if dead links shall rise an exception (default: False).",
         metavar='<True/False>')
     parser.add_argument(
@@ -69,10 +98,15 @@ def main() -> None:
     )
     parser.add_argument(
         "--ignore_urls",
-        type=str,
+        type=lambda urls: set(urls.split(',')),
         help="String with URls that will not be checked. Separate them with commas.",
         metavar="<str,str,str>"
     )
+    parser.add_argument(
+        "--use_processes",
+        type=_str_to_bool,
+        help="True to scan many files with one process per core (default: False).",
+        metavar='<True/False>')
 
     parser.add_argument(
         "--cache_file",
@@ -81,7 +115,7 @@ def main() -> None:
         metavar='<path>')
     parser.add_argument(
         "--dont_check_again_within_hours",
-        type=int,
+        type=_non_negative_int,
         help="Number of hours an already verified URL is considered valid (default: 24).",
         metavar="<hours>")
 
@@ -94,7 +128,6 @@ def main() -> None:
         "--template_name",
         type=str,
         help="Name of the template file.",
-        default='default.cli.jinja',
         metavar='<filename>')
 
     parser.add_argument(
@@ -111,40 +144,10 @@ def main() -> None:
     args = parser.parse_args()
 
     # Settings on the command line interface shall override any setting in a
-    # configfile and defaults. So if anything was set here, use it to override:
-    if args.searchpath:
-        checker.searchpath = pathlib.Path(args.searchpath)
-    if args.file_types:
-        checker.file_types = args.file_types
-
-    if args.num_workers:
-        checker.num_workers = args.num_workers
-    if args.timeout:
-        checker.timeout = args.timeout
-    if args.raise_for_dead_links:
-        if args.raise_for_dead_links in ("True", "true", "yes"):
-            checker.raise_for_dead_links = True
-        elif args.raise_for_dead_links in ("False", "false", "no"):
-            checker.raise_for_dead_links = False
-        else:
-            raise ValueError("Unknown value for raise_for_dead_links")
-    if args.user_agent:
-        checker.user_agent = args.user_agent
-    if args.ignore_urls:
-        checker.ignore_urls = args.ignore_urls
-
-    if args.cache_file:
-        checker.cache_file = args.cache_file
-    if args.dont_check_again_within_hours:
-        checker.dont_check_again_within_hours = args.dont_check_again_within_hours
-
-    if args.template_searchpath:
-        checker.template_searchpath = args.template_searchpath
-    if args.template_name:
-        checker.template_name = args.template_name
-    if args.write_to:
-        checker.write_to = args.write_to
-    if args.base_url:
-        checker.base_url = args.base_url
+    # configfile and defaults. Arguments have no defaults, so anything that
+    # is not None was set on the command line. Use it to override:
+    for name, value in vars(args).items():
+        if value is not None:
+            setattr(checker, name, value)
 
     checker.check(checker.searchpath)
@@ -9,9 +9,11 @@ Source: https://github.com/RuedigerVoigt/salted
 Released under the Apache License 2.0
 """
 
+import contextlib
+import itertools
 import logging
-import pathlib
-from typing import Optional, Union
+import time
+from typing import Dict, Final, Iterator, Optional
 
 from salted import memory_instance
 
@@ -19,68 +21,201 @@ from salted import memory_instance
 class DatabaseIO:
     "Log the crawler's results to sqlite."
 
+    # The results of the checks are buffered and written with executemany
+    # once this many rows of a kind are pending:
+    FLUSH_THRESHOLD: Final[int] = 500
+    # Links found in the files are staged and written in batches of:
+    LINK_BATCH_SIZE: Final[int] = 5000
+    # Older SQLite versions allow at most 999 parameters per statement.
+    MAX_SQL_PARAMETERS: Final[int] = 999
+
+    _SQL_INSERT_RESULT: Final[Dict[str, str]] = {
+        'validUrls': '''INSERT INTO validUrls
+                        (normalizedUrl, lastValid)
+                        VALUES (?, ?);''',
+        'errors': 'INSERT INTO errors VALUES (?, ?);',
+        'permanentRedirects': '''INSERT INTO permanentRedirects
+                                 (normalizedUrl, error)
+                                 VALUES (?, ?);''',
+        'exceptions': 'INSERT INTO exceptions VALUES (?, ?);'}
+
     def __init__(self,
-                 mem_instance: memory_instance.MemoryInstance,
-                 cache_file: Union[pathlib.Path, str] = None):
+                 mem_instance: memory_instance.MemoryInstance):
+        # The cache file is handled by the CacheReader.
+        self.mem_instance = mem_instance
+        self.conn = mem_instance.conn
         self.cursor = mem_instance.get_cursor()
-        self.cache_file_path = None
-        if cache_file:
-            self.cache_file_path = pathlib.Path(cache_file).resolve()
+        self._pending: Dict[str, list] = {
+            table: list() for table in self._SQL_INSERT_RESULT}
+        self._staged_links: list = list()
+        # Number of rows in the queue table. Tracked instead of counted.
+        self.num_links_in_queue = 0
+
+    @contextlib.contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Run all statements within the with-block in a single transaction.
+           The connection is in autocommit mode, so otherwise each statement
+           is a transaction of its own. If a transaction is already open,
+           the statements become part of it."""
+        if self.conn.in_transaction:
+            yield
+            return
+        # Results buffered before the block do not belong to it:
+        self.flush_all()
+        self.cursor.execute('BEGIN;')
+        try:
+            yield
+            self.__write_pending()
+        except Exception:
+            # Buffered results from within the block are discarded, too.
+            for rows in self._pending.values():
+                rows.clear()
+            self.cursor.execute('ROLLBACK;')
+            raise
+        self.cursor.execute('COMMIT;')
+
+    def __buffer_result(self,
+                        table: str,
+                        row: tuple) -> None:
+        "Buffer a result and write the buffer if it is full."
+        pending = self._pending[table]
+        pending.append(row)
+        if len(pending) >= self.FLUSH_THRESHOLD:
+            self.flush_all()
+
+    def __write_pending(self) -> None:
+        "Write all buffered results. Does not handle transactions."
+        for table, rows in self._pending.items():
+            if rows:
+                self.cursor.executemany(self._SQL_INSERT_RESULT[table], rows)
+                rows.clear()
+
+    def flush_all(self) -> None:
+        """Write all buffered results to the database. Has to be called
+           once all checks are done and before the results are read."""
+        if not any(self._pending.values()):
+            return
+        if self.conn.in_transaction:
+            self.__write_pending()
+            return
+        # In autocommit mode executemany commits every single row.
+        # Wrap it into one transaction. Cannot use self.transaction()
+        # as that calls this method.
+        self.cursor.execute('BEGIN;')
+        try:
+            self.__write_pending()
+        except Exception:
+            self.cursor.execute('ROLLBACK;')
+            raise
+        self.cursor.execute('COMMIT;')
+
+    def __bulk_insert(self,
+                      sql_head: str,
+                      num_columns: int,
+                      rows: list) -> None:
+        """Insert many rows with multi-row VALUES clauses. SQLite runs each
+           of those statements as one program, instead of one step per row
+           as with executemany. sql_head is the statement up to VALUES."""
+        rows_per_statement = self.MAX_SQL_PARAMETERS // num_columns
+        placeholder = '(' + ', '.join('?' * num_columns) + ')'
+        for start in range(0, len(rows), rows_per_statement):
+            chunk = rows[start:start + rows_per_statement]
+            self.cursor.execute(
+                f"{sql_head} VALUES {', '.join([placeholder] * len(chunk))};",
+                list(itertools.chain.from_iterable(chunk)))
 
     def save_found_links(self,
                          links_found: list) -> None:
         "Save the links found into the memory database."
         if not links_found:
             logging.debug('No links in this file to save them.')
-        else:
-            self.cursor.executemany('''
-            INSERT INTO queue
-            (filePath, hostname, url, normalizedUrl, linktext)
-            VALUES(?, ?, ?, ?, ?);''', links_found)
+            return
+        # Large lists need several statements. Run them in one transaction:
+        with self.transaction():
+            self.__bulk_insert(
+                'INSERT INTO queue '
+                '(filePath, hostname, url, normalizedUrl, linktext)',
+                5, links_found)
+        self.num_links_in_queue += len(links_found)
+
+    def stage_found_links(self,
+                          links_found: list) -> None:
+        """Collect the links found in a file and save them once enough
+           links from several files are staged."""
+        self._staged_links.extend(links_found)
+        if len(self._staged_links) >= self.LINK_BATCH_SIZE:
+            self.flush_staged_links()
+
+    def flush_staged_links(self) -> None:
+        "Save all staged links. Call this once all files are scanned."
+        if self._staged_links:
+            self.save_found_links(self._staged_links)
+            self._staged_links = list()
+
+    def collect_unique_urls(self) -> None:
+        """Copy every normalized URL in the queue once into uniqueUrls.
+           A single statement within SQLite instead of binding every URL
+           a second time from Python."""
+        self.cursor.execute('''
+            INSERT OR IGNORE INTO uniqueUrls (normalizedUrl)
+            SELECT normalizedUrl FROM queue;''')
 
     def save_found_dois(self,
                         dois_found: list) -> None:
-        "Save a list of DOIs into the in memory database."
+        """Save a list of DOIs into the in memory database. DOIs are
+           case-insensitive, so they are stored in lowercase."""
         if not dois_found:
             logging.debug('No DOI in this file to save them.')
             return None
-        self.cursor.executemany('''
-        INSERT INTO queue_doi
-        (filePath, doi, description)
-        VALUES (?, ?, ?);''', dois_found)
+        with self.transaction():
+            self.__bulk_insert(
+                'INSERT INTO queue_doi (filePath, doi, description)', 3,
+                [(file_path, doi.lower(), description)
+                 for file_path, doi, description in dois_found])
         return None
 
+    def has_urls_to_check(self) -> bool:
+        "Return True if there is at least one URL to check."
+        self.cursor.execute('SELECT 1 FROM uniqueUrls LIMIT 1;')
+        return self.cursor.fetchone() is not None
+
+    def has_dois_to_check(self) -> bool:
+        "Return True if there is at least one DOI to check."
+        self.cursor.execute('SELECT 1 FROM queue_doi LIMIT 1;')
+        return self.cursor.fetchone() is not None
+
     def urls_to_check(self) -> Optional[list]:
-        "Return a list of all distinct URLs to check."
-        self.cursor.execute('SELECT DISTINCT normalizedUrl FROM queue;')
-        return self.cursor.fetchall()
+        """Return a list of all distinct URLs to check as strings instead
+           of one tuple per row."""
+        # Not a generator: the cursor is reused to log results while the
+        # URLs are checked, which would reset a running query.
+        self.cursor.execute('SELECT normalizedUrl FROM uniqueUrls;')
+        return [row[0] for row in self.cursor]
 
     def get_dois_to_check(self) -> Optional[list]:
         """Return all DOI that are not validated yet or None
-           if DOI queue is empty."""
+           if DOI queue is empty. The queue holds the DOIs in lowercase, so
+           each one is returned once, however it was spelled in the files."""
         # Maybe replace it with a generator but for several thousnad DOIs
         # this way should be no problem!
         self.cursor.execute('SELECT DISTINCT doi FROM queue_doi;')
-        query_result = self.cursor.fetchall()
-        doi_list = [doi[0] for doi in query_result]
+        doi_list = [row[0] for row in self.cursor]
         return doi_list if doi_list else None
 
     def log_url_is_fine(self,
                         url: str) -> None:
         """If a request to an URL returns a HTTP status code that indicates a
            working hyperlink, note that with a timestamp."""
-        self.cursor.execute('''
-            INSERT INTO validUrls
-            (normalizedUrl, lastValid)
-            VALUES (?, strftime('%s','now'));''', [url])
+        self.__buffer_result('validUrls', (url, int(time.time())))
 
     def save_valid_dois(self, valid_dois: list) -> None:
         """Permanently store a list of valid DOIs in the cache.
            Contrary to URLs, DOIs are made to be persistent - so no need
            to recheck them once they have been validated."""
-        # TO DO: batches!!
-        self.cursor.executemany('''
-        INSERT OR IGNORE INTO validDois (doi) VALUES (?);''', valid_dois)
+        with self.transaction():
+            self.__bulk_insert(
+                'INSERT OR IGNORE INTO validDois (doi)', 1,
+                [(doi.lower(), ) for doi, in valid_dois])
 
     def log_invalid_dois(self,
                          invalid_dois: list) -> None:
@@ -93,24 +228,20 @@ class DatabaseIO:
                   error_code: int) -> None:
         """An error is logged for HTTP status codes that indicate a permanently
            broken link like '404 - File Not found' or '410 Gone'."""
-        self.cursor.execute('INSERT INTO errors VALUES (?, ?);',
-                            [url, error_code])
+        self.__buffer_result('errors', (url, error_code))
 
     def log_redirect(self,
                      url: str,
                      code: int) -> None:
         """Logs permanent redirects. Those links *should* be fixed. """
-        self.cursor.execute('''INSERT INTO permanentRedirects
-                               (normalizedUrl, error)
-                               VALUES (?, ?);''', [url, code])
+        self.__buffer_result('permanentRedirects', (url, code))
 
     def log_exception(self,
                       url: str,
                       exception_str: str) -> None:
         """An exception is logged if it was not possible to check
            a specific URL."""
-        self.cursor.execute('''INSERT INTO exceptions VALUES (?, ?);''',
-                            [url, exception_str])
+        self.__buffer_result('exceptions', (url, exception_str))
 
     def log_file_access_error(self,
                               file_path: str,
@@ -124,54 +255,57 @@ class DatabaseIO:
         """If links from a non-expired cache have been read, try to eliminate
            them in the list of URLs to check.
            Return the absolute number of (non-normalized) URLs to check."""
-
-        self.cursor.execute('SELECT COUNT(*) FROM queue;')
-        num_links_before = self.cursor.fetchone()[0]
-
+        self.flush_all()
+        # The subquery is not correlated: SQLite builds its result once and
+        # uses it (or the index on validUrls) for the lookups.
         self.cursor.execute('''DELETE FROM queue
                             WHERE normalizedUrl IN (
                             SELECT normalizedUrl FROM validUrls);''')
+        num_links_skipped = self.cursor.rowcount
+        self.cursor.execute('''DELETE FROM uniqueUrls
+                            WHERE normalizedUrl IN (
+                            SELECT normalizedUrl FROM validUrls);''')
+        self.num_links_in_queue -= num_links_skipped
 
-        self.cursor.execute('SELECT COUNT(*) FROM queue;')
-        num_links_after = self.cursor.fetchone()[0]
-
-        # if num_links_before > num_links_after:
-        #     msg = (f"Tests for {num_links_before - num_links_after} " +
-        #            "hyperlinks skipped - they checked out valid within " +
-        #            f"the last {self.dont_check_again_within_hours} " +
-        #            "hours.\n" +
-        #            f"{num_links_after} unique links have to be tested.")
-        #     logging.info(msg)
-        return num_links_after
+        if num_links_skipped > 0:
+            logging.debug("Skipped tests for %s hyperlinks: valid in cache.",
+                          num_links_skipped)
+        return self.num_links_in_queue
 
     def del_dois_that_can_be_skipped(self) -> None:
         "Delete DOI from the check queue which were already validated."
-        self.cursor.execute('SELECT COUNT(*) FROM queue_doi;')
-        num_dois_before = self.cursor.fetchone()[0]
-
+        # Both tables hold the DOIs in lowercase. Comparing the bare
+        # columns allows to use their indices.
         self.cursor.execute('''DELETE FROM queue_doi
-                            WHERE doi IN (
-                            SELECT doi FROM validDois);''')
-        self.cursor.execute('SELECT COUNT(*) FROM queue_doi;')
-        num_dois_after = self.cursor.fetchone()[0]
-
-        if num_dois_before > num_dois_after:
+                            WHERE doi IN (SELECT doi FROM validDois);''')
+        # rowcount is the number of deleted rows. No need to count the
+        # rows before and after.
+        if self.cursor.rowcount > 0:
             logging.info("Skipped tests for %s DOIs: already validated!",
-                         (num_dois_before - num_dois_after))
+                         self.cursor.rowcount)
+
+    def prepare_for_checks(self) -> None:
+        """Create the indices and remove everything from the queues that
+           the cache already marks as valid. All in a single transaction.
+           The indices are created first, so the deletes can use them."""
+        with self.transaction():
+            self.mem_instance.generate_indices()
+            self.collect_unique_urls()
+            self.del_links_that_can_be_skipped()
+            self.del_dois_that_can_be_skipped()
 
     def count_errors(self) -> int:
         "Return the number of errors."
+        self.flush_all()
         self.cursor.execute('SELECT COUNT(*) FROM errors;')
         return self.cursor.fetchone()[0]
 
     def list_errors(self,
                     error_code: int) -> list:
-        """Return a list of normalized URLs that yield a specific
+        """Return a list of normalized URLs (as strings) that yield a specific
            error code (from the HTTP status codes)."""
+        self.flush_all()
         self.cursor.execute('''SELECT normalizedUrl
                           FROM errors
                           WHERE error = ?;''', [error_code])
-        urls_with_error = self.cursor.fetchall()
-        if urls_with_error:
-            return urls_with_error
-        return list()
+        return [row[0] for row in self.cursor]
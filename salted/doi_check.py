@@ -24,7 +24,9 @@ class DoiCheck:
     # pylint: disable=too-few-public-methods
 
     API_BASE_URL: Final[str] = 'https://api.crossref.org/works/'
-    NUM_API_WORKERS: Final[int] = 5
+    # The rate limit is shared by all requests, so more parallel requests
+    # do not exceed it.
+    NUM_API_WORKERS: Final[int] = 10
 
     def __init__(self,
                  db_io: database_io.DatabaseIO) -> None:
@@ -46,42 +48,81 @@ class DoiCheck:
 
         self.pbar_doi: tqdm = None
 
+        # Shared rate limiter: minimal interval between two requests and
+        # the time (of the event loop) at which the next one may start.
+        # The interval is unknown until the first response arrives.
+        self.request_interval: float = 0.0
+        self.next_request_at: float = 0.0
+
         self.valid_doi_list: list = list()
         self.invalid_doi_list: list = list()
 
-    async def __create_session(self) -> None:
-        self.session = aiohttp.ClientSession(loop=asyncio.get_running_loop())
+    async def __get_session(self) -> aiohttp.ClientSession:
+        """Return the session for requests to the API. It is created on
+           first use and kept open until aclose() is called, so repeated
+           checks with this object reuse its connections."""
+        if self.session is None or self.session.closed:
+            await self.__create_session()
+        return self.session  # type: ignore[return-value]
 
-    async def __close_session(self) -> None:
-        "Close the session object once it is no longer needed."
+    async def __create_session(self) -> None:
+        """Create one session for all requests to the API. Each worker
+           keeps its connection alive and reuses it for the next DOI instead
+           of a new TCP and TLS handshake."""
+        connector = aiohttp.TCPConnector(
+            limit=self.NUM_API_WORKERS,
+            limit_per_host=self.NUM_API_WORKERS,
+            keepalive_timeout=30,
+            ttl_dns_cache=300,
+            enable_cleanup_closed=True)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers=self.headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout_sec))
+
+    async def aclose(self) -> None:
+        """Close the session once it is no longer needed. Has to be called
+           within the event loop that ran the checks."""
         if self.session:
             await self.session.close()
+            self.session = None
+
+    async def __aenter__(self) -> 'DoiCheck':
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        await self.aclose()
 
-    async def __rate_limit_wait(self,
-                                max_queries: int,
-                                seconds: int
-                                ) -> None:
-        """Sleep long enough to keep the number of API requests within
-        the rate limit. Always taking into account the newest values provided
-        by the server."""
+    def __update_rate_limit(self,
+                            max_queries: int,
+                            seconds: int
+                            ) -> None:
+        """Set the interval between two requests from the rate limit
+           the server reported with its latest response."""
 
         if max_queries < 1:
             raise ValueError('Parameter "max_queries" must be an integer > 0.')
-        if max_queries < 1:
+        if seconds < 1:
             raise ValueError('Parameter "seconds" must be an integer > 0.')
         # Keep it at 90% to always be below the limit. This is still fast,
         # given that standard for that API is 50 requests/second.
         # Input is a positive int != 0 and round rounds up, so the smallest
         # amount this can take is 1:
         max_queries = round(max_queries * 0.9)
-        # In a specified number of seconds, there is maximum number of queries.
-        # As the work is distributed over multiple workers, the wait time has
-        # to be multiplied by their number:
-        time_to_sleep = float((seconds / max_queries) * self.NUM_API_WORKERS)
-        logging.debug(f"wait time per worker for {max_queries} queries /" +
-                      f" {seconds} s: {time_to_sleep}")
-        await asyncio.sleep(time_to_sleep)
-        return None
+        # In a specified number of seconds, there is maximum number of
+        # queries. All requests share this budget:
+        self.request_interval = seconds / max_queries
+
+    async def __wait_for_rate_limit(self) -> None:
+        """Wait until the rate limit allows the next request. Reserves a slot
+           before sleeping, so the requests of all workers are spaced evenly
+           instead of each worker sleeping for the whole interval."""
+        now = asyncio.get_running_loop().time()
+        wait = self.next_request_at - now
+        self.next_request_at = (max(now, self.next_request_at) +
+                                self.request_interval)
+        if wait > 0:
+            await asyncio.sleep(wait)
 
     async def __api_send_head_request(self,
                                       doi: str) -> dict:
@@ -92,11 +133,10 @@ class DoiCheck:
         # The HTTP HEAD method requests the headers, but not the page's body.
         # Requesting this way reduces load on the server and network traffic.
         query_url = self.API_BASE_URL + doi
-        async with self.session.get(  # type: ignore
+        session = await self.__get_session()
+        async with session.head(
                 query_url,
-                headers=self.headers,
-                raise_for_status=False,
-                timeout=self.timeout_sec) as response:
+                raise_for_status=False) as response:
             # format is 'numeric s'
             timewindow = response.headers['X-Rate-Limit-Interval']
             timewindow = timewindow.rstrip('s').strip()
@@ -105,56 +145,53 @@ class DoiCheck:
                 'seconds':  timewindow,
                 'status': response.status}
 
-    async def __worker(self,
-                       name: str,
-                       queue: asyncio.Queue) -> None:
-        """Worker: wait for the result of the API request and then wait long
-           enough to stay within the rate limit."""
-        # DO NOT REMOVE 'while True'. Without that the queue is stopped
-        # after the first iteration.
-        while True:
-            doi = await queue.get()
-            api_response = await self.__api_send_head_request(doi)
+    async def __check_doi(self,
+                          semaphore: asyncio.Semaphore,
+                          doi: str) -> None:
+        """Wait for a slot within the rate limit, send the API request and
+           note the result. The semaphore limits the number of requests in
+           flight to NUM_API_WORKERS."""
+        async with semaphore:
+            await self.__wait_for_rate_limit()
+            try:
+                api_response = await self.__api_send_head_request(doi)
+            except (asyncio.TimeoutError, aiohttp.ClientError, KeyError):
+                # Log but do not raise. Raising would cancel the other checks.
+                logging.warning('Could not check DOI %s', doi, exc_info=True)
+                self.pbar_doi.update(1)
+                return
             if api_response['status'] == 200:
                 logging.debug("DOI %s is valid", doi)
-                self.valid_doi_list.append(doi)
+                # executemany needs tuples:
+                self.valid_doi_list.append((doi, ))
+                if len(self.valid_doi_list) >= self.db.FLUSH_THRESHOLD:
+                    self.__save_valid_dois()
             elif api_response['status'] == 404:
                 logging.debug("DOI %s does not exist!", doi)
-                self.invalid_doi_list.append(doi)
+                self.invalid_doi_list.append((doi, ))
             else:
                 print(f"Unexpected API response: {api_response['status']}")
-            await self.__rate_limit_wait(
+            self.__update_rate_limit(
                 int(api_response['max_queries']),
                 int(api_response['seconds']))
-            self.pbar_doi.update(1)
-            queue.task_done()
+        self.pbar_doi.update(1)
+
+    def __save_valid_dois(self) -> None:
+        """Write the valid DOIs found so far and empty the list.
+           The database is in memory, so this does not block the event
+           loop long enough to warrant moving it into a thread."""
+        if self.valid_doi_list:
+            self.db.save_valid_dois(self.valid_doi_list)
+            self.valid_doi_list = list()
 
     async def __distribute_work(self,
                                 doi_list: list) -> None:
-        """Start a queue and spawn workers to work in parallel."""
-        queue: asyncio.Queue = asyncio.Queue()
-        for entry in doi_list:
-            queue.put_nowait(entry)
-
-        await self.__create_session()
+        """Check all DOIs concurrently, bounded by a semaphore."""
+        semaphore = asyncio.Semaphore(self.NUM_API_WORKERS)
+        await asyncio.gather(
+            *(self.__check_doi(semaphore, doi) for doi in doi_list))
 
-        tasks = []
-        for i in range(int(self.NUM_API_WORKERS)):
-            task = asyncio.create_task(self.__worker(f'worker-{i}', queue))
-            tasks.append(task)
-        await queue.join()
-
-        # Cancel worker tasks.
-        for task in tasks:
-            task.cancel()
-
-        # Close aiohttp session
-        await self.__close_session()
-
-        # Wait until all worker tasks are cancelled.
-        await asyncio.gather(*tasks, return_exceptions=True)
-
-    def check_dois(self) -> None:
+    async def check_dois_async(self) -> None:
         "Check the DOI in the queue and show a progress bar."
         dois_to_check = self.db.get_dois_to_check()
         if not dois_to_check:
@@ -164,9 +201,19 @@ class DoiCheck:
         print(f"{num_doi} DOI to check:")
         self.pbar_doi = tqdm(total=num_doi)
 
-        asyncio.run(self.__distribute_work(dois_to_check))
-        # executemany needs a list of tuples:
-        if self.valid_doi_list:
-            self.db.save_valid_dois([(doi, ) for doi in self.valid_doi_list])
+        await self.__distribute_work(dois_to_check)
+        self.pbar_doi.close()
+        self.__save_valid_dois()
         if self.invalid_doi_list:
-            self.db.log_invalid_dois([(doi, ) for doi in self.invalid_doi_list])
+            self.db.log_invalid_dois(self.invalid_doi_list)
+
+    def check_dois(self) -> None:
+        """Check the DOI in the queue and show a progress bar.
+           Blocks until all checks are done."""
+        asyncio.run(self.__check_dois_and_close())
+
+    async def __check_dois_and_close(self) -> None:
+        """The event loop of check_dois ends with the checks, so the
+           session cannot outlive them."""
+        async with self:
+            await self.check_dois_async()
@@ -10,14 +10,16 @@ Released under the Apache License 2.0
 """
 
 import logging
+import os
 import pathlib
-from typing import Final, List, Optional
+from typing import FrozenSet, Final, Iterable, Iterator, List, Optional
 
 
 class FileFinder:
     "Methods to find files in supported formats"
 
-    SUPPORTED_SUFFIX: Final[set] = {".htm", ".html", '.md', '.tex', '.bib'}
+    SUPPORTED_SUFFIX: Final[FrozenSet[str]] = frozenset(
+        {".htm", ".html", '.md', '.tex', '.bib'})
 
     def __init__(self) -> None:
         return
@@ -25,28 +27,57 @@ class FileFinder:
     def is_supported_format(self,
                             filepath: pathlib.Path) -> bool:
         "Checks - using the filename suffix - if the file format is supported."
-        return bool(filepath.suffix in self.SUPPORTED_SUFFIX)
+        return bool(filepath.suffix.lower() in self.SUPPORTED_SUFFIX)
 
     def find_files_by_extensions(
             self,
             path_to_base_folder: pathlib.Path,
-            suffixes: Optional[set] = None) -> List[pathlib.Path]:
+            suffixes: Optional[Iterable[str]] = None) -> List[pathlib.Path]:
         """Find all files with specific file type suffixes in the base folder
            and its subfolders. If no file suffix is specified, this will look
-           for all file formats supported by salted."""
+           for all file formats supported by salted. The suffixes are matched
+           case-insensitive."""
         # self undefined at time of definition. Therefore fallback here:
         if not suffixes:
             suffixes = self.SUPPORTED_SUFFIX
+        suffixes_lower = frozenset(suffix.lower() for suffix in suffixes)
 
-        files_to_check = []
-        path_to_check = pathlib.Path(path_to_base_folder)
-        all_files = path_to_check.glob('**/*')
-        for candidate in all_files:
-            if candidate.suffix in suffixes:
-                files_to_check.append(candidate.resolve())
+        # Resolve the base folder once. The paths found below it are
+        # absolute then, without a resolve() for every single file.
+        base_folder = pathlib.Path(path_to_base_folder).resolve()
+        files_to_check = [
+            pathlib.Path(file_path) for file_path
+            in self.__walk(os.fspath(base_folder), suffixes_lower)]
         logging.debug('Found %s files', len(files_to_check))
         return files_to_check
 
+    @staticmethod
+    def __walk(base_folder: str,
+               suffixes_lower: FrozenSet[str]) -> Iterator[str]:
+        """Yield the path of every file in the folder and its subfolders
+           whose lowercase suffix is in suffixes_lower. os.scandir knows the
+           type of an entry without an additional stat call on most systems.
+           A stack instead of recursion avoids the recursion limit with deep
+           trees."""
+        folders = [base_folder]
+        while folders:
+            folder = folders.pop()
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            folders.append(entry.path)
+                            continue
+                        # Slicing the name string is cheaper than splitext.
+                        # A leading dot marks a hidden file, not a suffix.
+                        name = entry.name
+                        dot = name.rfind('.')
+                        if (dot > 0 and name[dot:].lower() in suffixes_lower
+                                and entry.is_file()):
+                            yield entry.path
+            except PermissionError:
+                logging.warning('Permission denied: cannot search %s', folder)
+
     def find_html_files(self,
                         path_to_base_folder: pathlib.Path
                         ) -> List[pathlib.Path]:
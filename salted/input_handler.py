@@ -9,11 +9,15 @@ Source: https://github.com/RuedigerVoigt/salted
 Released under the Apache License 2.0
 """
 
-from collections import Counter
+import concurrent.futures
+import functools
+import locale
 import logging
+import mmap
+import os
 import pathlib
-from typing import List, Optional
-import urllib.parse
+import re
+from typing import Callable, Dict, Final, List, Optional, Tuple, Union
 
 import userprovided
 from tqdm.asyncio import tqdm  # type: ignore
@@ -22,71 +26,192 @@ from salted import database_io
 from salted import parser
 
 
+# The host part of a http(s) URL: after optional user information and
+# before an optional port. The user information ends at the last '@' of the
+# network location, as in urllib.parse. IPv6 addresses are enclosed in brackets.
+# Matching this is much cheaper than urllib.parse.urlparse, which splits
+# the whole URL only to get the hostname.
+_PATTERN_HOST = re.compile(
+    r"https?://(?:[^/?#]*@)?(?:\[(?P<ipv6>[^\]/?#]*)\]|(?P<host>[^/:?#]*))",
+    flags=re.IGNORECASE)
+
+# Start of the problem reported for files above the size limit:
+_TOO_LARGE = 'file too large'
+
+
+# Documents often repeat the same URLs (navigation, citations). The caches
+# make sure each of them is only parsed once per process.
+@functools.lru_cache(maxsize=100_000)
+def _hostname(url: str) -> Optional[str]:
+    """Return the lowercase hostname of a http(s) URL or None if there is
+       none. Like the hostname attribute of urllib.parse.urlparse."""
+    match = _PATTERN_HOST.match(url)
+    if not match:
+        return None
+    host = match['ipv6'] if match['ipv6'] is not None else match['host']
+    return host.lower() if host else None
+
+
+@functools.lru_cache(maxsize=100_000)
+def _normalize_url(url: str) -> str:
+    "Return the normalized version of an URL."
+    try:
+        return userprovided.url.normalize_url(url)
+    except userprovided.err.QueryKeyConflict:
+        return userprovided.url.normalize_url(
+            url, do_not_change_query_part=True)
+
+
+def _decode(data: Union[bytes, mmap.mmap]) -> str:
+    """Decode the content of a file as open() in text mode would, but try
+       UTF-8 first: a file that is not valid UTF-8 is decoded with the
+       encoding of the locale. Windows and old Mac line endings are
+       normalized (universal newlines), so they do not end up in link
+       texts."""
+    try:
+        text = str(data, 'utf-8')
+    except UnicodeDecodeError:
+        text = str(data, locale.getpreferredencoding(False))
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
 class InputHandler:
     """read files and extract the hyperlinks inside them."""
 
+    # Mapping a file into memory has a fixed setup cost. Smaller files
+    # are read the conventional way.
+    MMAP_MIN_SIZE: Final[int] = 8192
+    # Default limit. Larger files are not scanned. Those are most likely
+    # generated and reading them could stall the run:
+    MAX_FILE_SIZE: Final[int] = 10 << 20  # 10 MiB
+    # Starting worker processes has a fixed cost, too. Fewer files are
+    # parsed by threads, even if processes are allowed.
+    MIN_FILES_FOR_PROCESSES: Final[int] = 100
+
     def __init__(self,
-                 db: database_io.DatabaseIO):
+                 db: database_io.DatabaseIO,
+                 max_file_size: int = MAX_FILE_SIZE,
+                 use_processes: bool = False):
         self.db = db
-        self.cnt: Counter = Counter()
+        # in bytes
+        self.max_file_size = max_file_size
+        # Worker processes re-import the __main__ module of the caller on
+        # platforms which do not fork. So they are only started on request.
+        self.use_processes = use_processes
+        self.cnt: Dict[str, int] = {
+            'links_found': 0,
+            'unsupported_scheme': 0}
         self.parser = parser.Parser()
+        # Choose the function to extract links with a single lookup.
+        # BibTeX is handled separately, as it also returns DOIs.
+        self.__extract_links: Dict[str, Callable[[str], list]] = {
+            '.htm': self.parser.extract_links_from_html,
+            '.html': self.parser.extract_links_from_html,
+            '.md': self.parser.extract_links_from_markdown,
+            '.tex': self.parser.extract_links_from_tex}
 
-    def read_file_content(self,
-                          path_to_file: pathlib.Path) -> Optional[str]:
-        "Return the file content or log an error if file cannot be accessed."
-        content: Optional[str] = None
+    def __read_file(self,
+                    path_to_file: pathlib.Path
+                    ) -> Tuple[Optional[str], Optional[str]]:
+        """Return the file content and None, or None and the reason why the
+           file could not be read.
+           Small files are read with a single system call into a buffer of
+           their exact size, without creating a file object. Larger files
+           are memory mapped and decoded in one step instead of being copied
+           chunk by chunk through a buffered reader."""
         try:
-            with open(path_to_file, 'r') as code:
-                content = code.read()
+            # O_BINARY only exists (and is needed) on Windows:
+            file_descriptor = os.open(
+                path_to_file, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            try:
+                # The size is known from fstat anyway, so this costs no
+                # additional system call:
+                size = os.fstat(file_descriptor).st_size
+                if size > self.max_file_size:
+                    return None, (f"{_TOO_LARGE} ({size} bytes, limit " +
+                                  f"{self.max_file_size})")
+                if size < self.MMAP_MIN_SIZE:
+                    return _decode(os.read(file_descriptor, size)), None
+                with mmap.mmap(file_descriptor, 0,
+                               access=mmap.ACCESS_READ) as mapped:
+                    # MADV_SEQUENTIAL is not available on all systems
+                    if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                        mapped.madvise(mmap.MADV_SEQUENTIAL)
+                    return _decode(mapped), None
+            finally:
+                os.close(file_descriptor)
         except FileNotFoundError:
-            self.db.log_file_access_error(
-                str(path_to_file), 'file not found')
+            return None, 'file not found'
         except PermissionError:
-            self.db.log_file_access_error(
-                str(path_to_file), 'permission error')
+            return None, 'permission error'
         except TimeoutError:
-            self.db.log_file_access_error(
-                str(path_to_file), 'system timeout')
+            return None, 'system timeout'
         except BlockingIOError:
-            self.db.log_file_access_error(
-                str(path_to_file), 'blocking IO')
+            return None, 'blocking IO'
         except Exception as unexpected:  # pylint: disable=W0703
-            self.db.log_file_access_error(
-                str(path_to_file), str(unexpected))
-        finally:  # pylint: disable=W0150
-            return content
+            return None, str(unexpected)
 
-    def handle_found_urls(self,
-                          file_path: pathlib.Path,
-                          url_list: list) -> None:
-        """Extract all hyperlinks from url_list, normalize them and
-           add them to test queue."""
+    def read_file_content(self,
+                          path_to_file: pathlib.Path) -> Optional[str]:
+        "Return the file content or log an error if file cannot be accessed."
+        content, problem = self.__read_file(path_to_file)
+        if problem:
+            self.db.log_file_access_error(str(path_to_file), problem)
+        return content
+
+    def parse_file(self,
+                   file_path: pathlib.Path
+                   ) -> Tuple[Optional[list], Optional[list], Optional[str]]:
+        """Read a file and extract its hyperlinks and DOIs. Return the list
+           of links, the list of DOIs and the reason if the file could not be
+           read. Does not access the database, so several threads can call
+           this at the same time."""
+        content, problem = self.__read_file(file_path)
+        if not content:
+            return None, None, problem
+
+        # The file finder matches suffixes case-insensitive:
+        suffix = file_path.suffix.lower()
+        if suffix == ".bib":
+            # only one function returns two values
+            url_list, doi_list = self.parser.extract_links_from_bib(content)
+            return url_list, doi_list, None
+        try:
+            extract_links = self.__extract_links[suffix]
+        except KeyError:
+            raise RuntimeError(
+                'Invalid extension. Should never happen.') from None
+        return extract_links(content), None, None
+
+    def prepare_links(self,
+                      file_path: pathlib.Path,
+                      url_list: list) -> Tuple[list, int]:
+        """Normalize the hyperlinks in url_list and turn them into rows for
+           the test queue. Return those rows and the number of links with an
+           unsupported scheme. Does not access the database."""
 
         links_found: list = []
-        mailto_found: list = []
+        num_unsupported = 0
+        file_name = str(file_path)
 
-        for link in url_list:
-            url = link[0]
-            linktext = link[1]
+        for url, linktext in url_list:
             if url.startswith('http'):
                 # It may be that multiple links point to the same resource.
                 # Normalizing them means they only need to be tested once.
                 # The non-normalized version is stored anyway, because in case
                 # the link is broken, that version is used to show the user
                 # the broken links on a specific page.
-                try:
-                    normalized_url = userprovided.url.normalize_url(url)
-                except userprovided.err.QueryKeyConflict:
-                    normalized_url = userprovided.url.normalize_url(
-                        url, do_not_change_query_part=True)
-
-                parsed_url = urllib.parse.urlparse(url)
-                links_found.append([str(file_path),
-                                    parsed_url.hostname,
+                normalized_url = _normalize_url(url)
+
+                # A tuple needs less memory than a list and is
+                # pickled faster when sent back from a worker process.
+                links_found.append((file_name,
+                                    _hostname(url),
                                     url,
                                     normalized_url,
-                                    linktext])
-                self.cnt['links_found'] += 1
+                                    linktext))
 
             elif url.startswith('mailto:'):
                 logging.debug("Checking mailto Links is not implemented yet")
@@ -104,43 +229,75 @@ class InputHandler:
                 #         pass
             else:
                 # cannot check this kind of link
-                self.cnt['unsupported_scheme'] += 1
+                num_unsupported += 1
+        return links_found, num_unsupported
+
+    def handle_found_urls(self,
+                          file_path: pathlib.Path,
+                          url_list: list) -> None:
+        """Extract all hyperlinks from url_list, normalize them and
+           add them to test queue."""
+        self.__queue_links(*self.prepare_links(file_path, url_list))
 
-        # Push the found links once for each file instead for all files
-        # at once. The latter would kill performance for large document
-        # collections.
+    def __queue_links(self,
+                      links_found: list,
+                      num_unsupported: int) -> None:
+        "Count the prepared links and add them to the test queue."
+        self.cnt['links_found'] += len(links_found)
+        self.cnt['unsupported_scheme'] += num_unsupported
+        # Stage the links: they are saved in batches spanning several files.
+        # The batch size is limited, as holding the links of all files at
+        # once would kill performance for large document collections.
         if links_found:
-            self.db.save_found_links(links_found)
-        if mailto_found:
-            pass
+            self.db.stage_found_links(links_found)
+
+    def scan_file(self,
+                  file_path: pathlib.Path
+                  ) -> Tuple[Optional[list], int, Optional[list],
+                             Optional[str]]:
+        """Read a file, extract its hyperlinks and DOIs and prepare the
+           links for the test queue. Return the rows for the queue, the
+           number of links with an unsupported scheme, the list of DOIs and
+           the reason if the file could not be read. Does not access the
+           database, so it can run in worker threads and processes."""
+        url_list, doi_list, problem = self.parse_file(file_path)
+        if not url_list:
+            return None, 0, doi_list, problem
+        links_found, num_unsupported = self.prepare_links(file_path, url_list)
+        return links_found, num_unsupported, doi_list, None
 
     def handle_found_dois(self,
                           file_path: pathlib.Path,
                           doi_list: list) -> None:
-        """Change the DOI list into the needed format and send it piecewise
-           to the database."""
+        """Change the DOI list into the needed format and send it to the
+           database."""
         if not doi_list:
             return None
         # The parser generated a list in the format [[doi, text], [doi, text]]
         #  - text being the key-value of the bibtex-entry and the field in
         # which the DOI was found.
-        dois_found = list()
-        for entry in doi_list:
-            dois_found.append([str(file_path), entry[0], entry[1]])
-        # In case of a bibliography taht can be a very long list.
-        # So feed it to sqlite in little pieces
-        first = 0
-        step = 50
-        last = first + step
-        if len(dois_found) < step:
-            self.db.save_found_dois(dois_found)
-        else:
-            while last <= (len(dois_found) - 1):
-                self.db.save_found_dois(dois_found[first:last])
-                first += step
-                last += step
+        file_name = str(file_path)
+        # Even a very long bibliography is saved at once: the database
+        # splits it into multi-row inserts within a single transaction.
+        self.db.save_found_dois(
+            [(file_name, doi, text) for doi, text in doi_list])
         return None
 
+    def __create_executor(self,
+                          num_files: int) -> concurrent.futures.Executor:
+        """Parsing files and normalizing links is CPU bound and holds the
+           GIL. So if allowed, many files are spread over one process per
+           core. Otherwise files are read by threads which overlap the waits
+           for the disk."""
+        if self.use_processes and num_files >= self.MIN_FILES_FOR_PROCESSES:
+            try:
+                return concurrent.futures.ProcessPoolExecutor()
+            except (NotImplementedError, OSError):
+                # Some platforms lack the needed semaphores.
+                logging.debug('Cannot start worker processes.', exc_info=True)
+        return concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(32, (os.cpu_count() or 4) * 2))
+
     def scan_files(self,
                    files_to_check: List[pathlib.Path]) -> None:
         """Scan each file within a list of paths for hyperlinks and DOIs.
@@ -154,29 +311,41 @@ class InputHandler:
         self.cnt['links_found'] = 0
 
         print("Scanning files for links:")
-        for file_path in tqdm(files_to_check):
-            content = self.read_file_content(file_path)
-            if not content:
-                # If for any reason this file could not be read, try the next.
-                continue
-
-            # only one function returns two values
-            doi_list: Optional[list] = None
-
-            if file_path.suffix in {".htm", ".html"}:
-                url_list = self.parser.extract_links_from_html(content)
-            elif file_path.suffix in {".md"}:
-                url_list = self.parser.extract_links_from_markdown(content)
-            elif file_path.suffix in {".tex"}:
-                url_list = self.parser.extract_links_from_tex(content)
-            elif file_path.suffix in {".bib"}:
-                url_list, doi_list = self.parser.extract_links_from_bib(content)
+        # The database is only written from this thread.
+        with self.__create_executor(len(files_to_check)) as executor:
+            if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+                results = executor.map(
+                    functools.partial(_scan_file_in_process,
+                                      max_file_size=self.max_file_size),
+                    files_to_check,
+                    chunksize=32)
             else:
-                raise RuntimeError('Invalid extension. Should never happen.')
-
-            if url_list:
-                self.handle_found_urls(file_path, url_list)
-            if doi_list:
-                self.handle_found_dois(file_path, doi_list)
+                results = executor.map(self.scan_file, files_to_check)
+            for file_path, result in zip(
+                    files_to_check,
+                    tqdm(results, total=len(files_to_check))):
+                links_found, num_unsupported, doi_list, problem = result
+                if problem:
+                    # If for any reason this file could not be read,
+                    # log that and try the next.
+                    if problem.startswith(_TOO_LARGE):
+                        logging.warning('Skipped %s: %s', file_path, problem)
+                    self.db.log_file_access_error(str(file_path), problem)
+                    continue
+                self.__queue_links(links_found or [], num_unsupported)
+                if doi_list:
+                    self.handle_found_dois(file_path, doi_list)
+        self.db.flush_staged_links()
 
         return None
+
+
+def _scan_file_in_process(file_path: pathlib.Path,
+                          max_file_size: int = InputHandler.MAX_FILE_SIZE
+                          ) -> Tuple[Optional[list], int, Optional[list],
+                                     Optional[str]]:
+    """Scan a file within a worker process. A module level function, as
+       the InputHandler holds a database connection which cannot be sent
+       to another process."""
+    return InputHandler(
+        None, max_file_size).scan_file(file_path)  # type: ignore[arg-type]
@@ -11,18 +11,40 @@ Released under the Apache License 2.0
 
 import logging
 import sqlite3
+from typing import Dict, Final, Tuple
 
 
 class MemoryInstance():
     "Handles the in memory instance of the database"
+
+    # Indices of the tables that are kept in the cache file:
+    # name: (table, columns, unique)
+    CACHE_INDICES: Final[Dict[str, Tuple[str, Tuple[str, ...], bool]]] = {
+        # Covers the query that loads the cache: the fresh entries are
+        # found by a range scan and read from the index alone.
+        'index_timestamp': ('validUrls', ('lastValid', 'normalizedUrl'),
+                            False),
+        'index_valid_url': ('validUrls', ('normalizedUrl', ), False),
+        'index_valid_doi': ('validDois', ('doi', ), True)}
+
     def __init__(self) -> None:
         "Initialize the in memory instance of sqlite"
         logging.debug('Initializing in memory database.')
         self.conn = sqlite3.connect(
             ':memory:',
-            isolation_level=None  # reenable autocommit
+            isolation_level=None,  # reenable autocommit
+            # sqlite3 keeps compiled statements in a per connection cache
+            # keyed by the SQL text. Make it large enough to hold all
+            # statements of a run, so none is parsed twice:
+            cached_statements=256
             )
         self.cursor = self.conn.cursor()
+        # Journal mode, synchronous and mmap_size do not matter for an in
+        # memory database. Keep temporary tables and indices (for example
+        # for DISTINCT) in memory and allow a page cache of up to 64 MB:
+        self.cursor.executescript('''
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-65536;''')
         self.create_schema()
 
     def get_cursor(self) -> sqlite3.Cursor:
@@ -50,6 +72,13 @@ class MemoryInstance():
             url text,
             normalizedUrl text,
             linktext text);''')
+        # Table 'uniqueUrls': every normalized URL in the queue exactly once.
+        # The primary key drops duplicates when they are inserted, so the
+        # URLs to check do not have to be deduplicated when read.
+        self.cursor.execute('''
+            CREATE TABLE uniqueUrls (
+            normalizedUrl text PRIMARY KEY
+            ) WITHOUT ROWID;''')
         # Table 'queue_doi': DOIs to be tested
         self.cursor.execute('''
             CREATE TABLE queue_doi (
@@ -98,42 +127,57 @@ class MemoryInstance():
         # but would be updated with every insert. It is faster to create it
         # once the table has it contents.
         logging.debug('Generating indices')
-        self.cursor.execute('''
-            CREATE INDEX IF NOT EXISTS index_timestamp
-            ON validUrls (lastValid);''')
+        # The backup copies these indices into the cache file:
+        self.create_cache_indices(self.conn)
         self.cursor.execute('''
             CREATE INDEX IF NOT EXISTS index_normalized_url
             ON queue (normalizedUrl);''')
         self.cursor.execute('''
-            CREATE UNIQUE INDEX IF NOT EXISTS index_valid_doi
-            ON validDois (doi);''')
+            CREATE INDEX IF NOT EXISTS index_queue_doi
+            ON queue_doi (doi);''')
+
+    @classmethod
+    def create_cache_indices(cls,
+                             connection: sqlite3.Connection) -> None:
+        """Create the indices of the cached tables if they do not exist.
+           An index with the same name, but other columns (as written by
+           older versions) is replaced."""
+        for name, (table, columns, unique) in cls.CACHE_INDICES.items():
+            existing = tuple(
+                row[2] for row in connection.execute(
+                    f"PRAGMA index_info({name});"))
+            if existing and existing != columns:
+                connection.execute(f"DROP INDEX {name};")
+            connection.execute(f'''
+                CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name}
+                ON {table} ({', '.join(columns)});''')
 
     def generate_db_views(self) -> None:
         """ Generate Views for Analytics and Output Generating."""
         # Separate function to execute after all links have been checked
         # and the respective tables are stable."""
         logging.debug('Generating database views')
-        self.cursor.execute('''
-            CREATE VIEW IF NOT EXISTS v_errorCountByFile AS
-            SELECT COUNT(*) AS numErrors, filePath
-            FROM queue
-            WHERE normalizedUrl IN (
-            SELECT normalizedUrl FROM errors
-            ) GROUP BY filePath;''')
-        self.cursor.execute('''
-            CREATE VIEW IF NOT EXISTS v_redirectCountByFile AS
-            SELECT COUNT(*) AS numRedirects, filePath
-            FROM queue
-            WHERE normalizedUrl IN (
-            SELECT normalizedUrl FROM permanentRedirects
-            ) GROUP BY filePath;''')
-        self.cursor.execute('''
-            CREATE VIEW IF NOT EXISTS v_exceptionCountByFile AS
-            SELECT COUNT(*) AS numExceptions, filePath
+        # The results are complete now. Index them once instead of updating
+        # the indices with every logged result. The views look them up by
+        # URL.
+        for table in ('errors', 'permanentRedirects', 'exceptions'):
+            self.cursor.execute(f'''
+                CREATE INDEX IF NOT EXISTS index_{table}_url
+                ON {table} (normalizedUrl);''')
+        # Count the errors, redirects and exceptions per file in a single
+        # scan of the queue. Each IN subquery is evaluated only once.
+        self.cursor.execute('''
+            CREATE VIEW IF NOT EXISTS v_countsByFile AS
+            SELECT filePath,
+            SUM(normalizedUrl IN (
+                SELECT normalizedUrl FROM errors)) AS numErrors,
+            SUM(normalizedUrl IN (
+                SELECT normalizedUrl FROM permanentRedirects)) AS numRedirects,
+            SUM(normalizedUrl IN (
+                SELECT normalizedUrl FROM exceptions)) AS numExceptions
             FROM queue
-            WHERE normalizedUrl IN (
-            SELECT normalizedUrl FROM exceptions
-            ) GROUP BY filePath;''')
+            GROUP BY filePath
+            HAVING numErrors + numRedirects + numExceptions > 0;''')
 
         self.cursor.execute('''
             CREATE VIEW IF NOT EXISTS v_errorsByFile AS
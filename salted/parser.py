@@ -12,73 +12,86 @@ Released under the Apache License 2.0
 import re
 
 from bs4 import BeautifulSoup  # type: ignore
+import lxml.etree  # type: ignore
+import lxml.html  # type: ignore
 from pybtex.database import parse_string # type: ignore
 # a future version of pybtex might get type hints, see:
 # https://bitbucket.org/pybtex-devs/pybtex/issues/141/type-annotations
 
 
+# The patterns are compiled once at import and shared by all instances.
+
+# Specification: https://www.ctan.org/pkg/hyperref
+_PATTERN_LATEX_URL = re.compile(
+    r"\\url\{(?P<url>[^{]*?)\}",
+    flags=re.MULTILINE | re.IGNORECASE)
+_PATTERN_LATEX_HREF = re.compile(
+    r"\\href(\[.*\]){0,1}\{(?P<url>[^}]*)\}\{(?P<linktext>[^}]*?)\}",
+    flags=re.MULTILINE | re.IGNORECASE)
+
+# Specs:
+# https://pandoc.org/MANUAL.html
+# https://daringfireball.net/projects/markdown/syntax
+# https://github.github.com/gfm/
+# These patterns contain no letters and no anchors, so they need neither
+# IGNORECASE nor MULTILINE. Without IGNORECASE the engine compares
+# characters directly instead of folding their case first.
+_PATTERN_MD_LINK = re.compile(
+    r"\[(?P<linktext>[^\[]*)\]\((?P<url>[^\)]*?)[\s\)]+")
+_PATTERN_MD_LINK_POINTY = re.compile(
+    r"<(?P<url>[^>]*?)>")
+
+
 class Parser():
     "Methods to extract hyperlinks and mail addresses from different formats."
 
     def __init__(self) -> None:
-
-        # Specification: https://www.ctan.org/pkg/hyperref
-        self.pattern_latex_url = re.compile(
-            r"\\url\{(?P<url>[^{]*?)\}",
-            flags=re.MULTILINE | re.IGNORECASE)
-        self.pattern_latex_href = re.compile(
-            r"\\href(\[.*\]){0,1}\{(?P<url>[^}]*)\}\{(?P<linktext>[^}]*?)\}",
-            flags=re.MULTILINE | re.IGNORECASE)
-
-        # Specs:
-        # https://pandoc.org/MANUAL.html
-        # https://daringfireball.net/projects/markdown/syntax
-        # https://github.github.com/gfm/
-        self.pattern_md_link = re.compile(
-            r"\[(?P<linktext>[^\[]*)\]\((?P<url>[^\)]*?)[\s\)]+",
-            flags=re.MULTILINE | re.IGNORECASE)
-        self.pattern_md_link_pointy = re.compile(
-            r"<(?P<url>[^>]*?)>",
-            flags=re.MULTILINE | re.IGNORECASE)
+        self.pattern_latex_url = _PATTERN_LATEX_URL
+        self.pattern_latex_href = _PATTERN_LATEX_HREF
+        self.pattern_md_link = _PATTERN_MD_LINK
+        self.pattern_md_link_pointy = _PATTERN_MD_LINK_POINTY
 
     @staticmethod
     def extract_links_from_html(file_content: str) -> list:
-        """Extract all links from a HTML file."""
-        matches = []
-        soup = BeautifulSoup(file_content, 'html.parser')
-        for link in soup.find_all('a'):
-            matches.append([link.get('href'), link.text])
-        return matches
+        """Extract all links from a HTML file.
+        Returns a list of lists: [[url, linktext], [url, linktext]]
+        Uses the C-based parser of lxml and falls back to BeautifulSoup
+        if lxml rejects the content (for example an empty file or an XML
+        declaration with encoding)."""
+        try:
+            document = lxml.html.fromstring(file_content)
+        except (lxml.etree.ParserError, ValueError):
+            soup = BeautifulSoup(file_content, 'html.parser')
+            return [[link.get('href'), link.text]
+                    for link in soup.find_all('a', href=True)]
+        # Anchors without href (like <a name="...">) are no links.
+        return [[link.get('href'), str(link.text_content())]
+                for link in document.iter('a')
+                if link.get('href') is not None]
 
     def extract_links_from_markdown(self,
                                     file_content: str) -> list:
         """Extract all links from a Markdown file.
         Returns a list of lists: [[url, linktext], [url, linktext]]"""
-        matches = []
-        md_links_in_file = re.findall(self.pattern_md_link, file_content)
-        for match in md_links_in_file:
-            matches.append([match[1], match[0]])
-        pointy_links_in_file = re.findall(self.pattern_md_link_pointy,
-                                          file_content)
-        for url in pointy_links_in_file:
-            matches.append([url, url])
+        # List comprehensions instead of append calls in a loop:
+        matches = [[url, linktext] for linktext, url
+                   in self.pattern_md_link.findall(file_content)]
+        matches.extend([url, url] for url
+                       in self.pattern_md_link_pointy.findall(file_content))
         return matches
 
     def extract_links_from_tex(self,
                                file_content: str) -> list:
         """Extract all links from a .tex file.
         Returns a list of lists: [[url, linktext], [url, linktext]]"""
-        matches = []
         # extract class \href{url}{text} links
-        href_in_file = re.findall(self.pattern_latex_href, file_content)
-        for match in href_in_file:
-            # The RegEx returns the optinal Element as first element.
-            # (Empty, but still in the return if it is not in the string.)
-            matches.append([match[1], match[2]])
+        # The RegEx returns the optinal Element as first element.
+        # (Empty, but still in the return if it is not in the string.)
+        matches = [[url, linktext] for _, url, linktext
+                   in self.pattern_latex_href.findall(file_content)]
         # extract \url{url} links
-        url_in_file = re.findall(self.pattern_latex_url, file_content)
-        for url in url_in_file:
-            matches.append([url, url])
+        matches.extend([url, url] for url
+                       in self.pattern_latex_url.findall(file_content))
         return matches
 
     @staticmethod
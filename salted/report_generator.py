@@ -29,6 +29,7 @@ class ReportGenerator:
         self.show_redirects = show_redirects
         self.show_exceptions = show_exceptions
         self.replace_path_by_url: Optional[dict] = None
+        self._counts_by_file: Optional[list] = None
 
     def rewrite_path(self,
                      path_to_rewrite: str) -> str:
@@ -36,15 +37,35 @@ class ReportGenerator:
            with the base URL."""
         # Silence mypy index error, because this assures the values
         # are available:
-        if not self.replace_path_by_url['path_to_be_replaced']:  # type: ignore
+        to_be_replaced = self.replace_path_by_url['path_to_be_replaced']  # type: ignore
+        replace_with = self.replace_path_by_url['replace_with_url']  # type: ignore
+        if not to_be_replaced:
             raise ValueError('Cannot replace in URL not knowing what.')
-        if not self.replace_path_by_url['replace_with_url']:  # type: ignore
+        if not replace_with:
             raise ValueError('Cannot replace in URL not knowing with what.')
 
-        return path_to_rewrite.replace(
-            self.replace_path_by_url['path_to_be_replaced'],  # type: ignore
-            self.replace_path_by_url['replace_with_url'],  # type: ignore
-            1)
+        # All checked files are within the folder, so its path is a prefix
+        # of the file path. Checking the prefix is cheaper than a search.
+        if path_to_rewrite.startswith(to_be_replaced):
+            return replace_with + path_to_rewrite[len(to_be_replaced):]
+        return path_to_rewrite.replace(to_be_replaced, replace_with, 1)
+
+    def __files_with(self,
+                     column: int) -> list:
+        """Return a list of (file path, count) for all files with at least
+           one error (column 1), redirect (2) or exception (3). Sorted by the
+           count in descending order. The counts for all three kinds are
+           read at once on the first call."""
+        if self._counts_by_file is None:
+            cursor = self.db.get_cursor()
+            cursor.execute('''SELECT filePath, numErrors, numRedirects,
+                              numExceptions
+                              FROM v_countsByFile;''')
+            self._counts_by_file = cursor.fetchall()
+        files = [(row[0], row[column]) for row in self._counts_by_file
+                 if row[column] > 0]
+        files.sort(key=lambda entry: (-entry[1], entry[0]))
+        return files
 
     def generate_access_error_list(self) -> Optional[list]:
         """If there were errors reading the files (FileNotFoundError, ...)
@@ -68,11 +89,7 @@ class ReportGenerator:
            permanent errors in that file, and a list of the actual errors."""
         cursor = self.db.get_cursor()
         result = list()
-        cursor.execute(
-            '''SELECT filePath, numErrors
-               FROM v_errorCountByFile
-               ORDER BY numErrors DESC, filePath ASC;''')
-        pages_w_permanent_errors = cursor.fetchall()
+        pages_w_permanent_errors = self.__files_with(1)
         if not pages_w_permanent_errors:
             return None
         for file_path, num_errors in pages_w_permanent_errors:
@@ -95,11 +112,7 @@ class ReportGenerator:
            permanent redirects in that file, and a list of the redirects."""
         cursor = self.db.get_cursor()
         result = list()
-        cursor.execute(
-            '''SELECT filePath, numRedirects
-                FROM v_redirectCountByFile
-                ORDER BY numRedirects DESC, filePath ASC;''')
-        pages_w_redirects = cursor.fetchall()
+        pages_w_redirects = self.__files_with(2)
         if not pages_w_redirects:
             return None
         for file_path, num_redirects in pages_w_redirects:
@@ -123,11 +136,7 @@ class ReportGenerator:
            actual exceptions."""
         cursor = self.db.get_cursor()
         result = list()
-        cursor.execute(
-            '''SELECT filePath, numExceptions
-                FROM v_exceptionCountByFile
-                ORDER BY numExceptions DESC, filePath ASC;''')
-        pages_w_exceptions = cursor.fetchall()
+        pages_w_exceptions = self.__files_with(3)
         if not pages_w_exceptions:
             return None
         for file_path, num_exceptions in pages_w_exceptions:
@@ -9,9 +9,8 @@ Source: https://github.com/RuedigerVoigt/salted
 Released under the Apache License 2.0
 """
 import asyncio
-from collections import Counter
 import logging
-from typing import Optional, Union
+from typing import Dict, Optional, Union
 
 import aiohttp
 from tqdm.asyncio import tqdm  # type: ignore
@@ -41,14 +40,35 @@ class UrlCheck:
 
         self.num_workers: Union[int, str] = workers
 
-        self.cnt: Counter = Counter()
+        self.cnt: Dict[str, int] = {
+            'checked_urls': 0,
+            'fine': 0,
+            'neededFullRequest': 0,
+            'ignored_urls': 0}
 
         self.pbar_links: tqdm = None
+        # Finished checks not yet shown in the progress bar:
+        self._pbar_delta = 0
 
         self.session: aiohttp.ClientSession = None  # type: ignore
 
     async def __create_session(self) -> None:
-        self.session = aiohttp.ClientSession(loop=asyncio.get_running_loop())
+        """Create one session for all checks. Its connector pools the
+           connections, so keep-alive and TLS sessions get reused for
+           all URLs on the same host."""
+        # Many links point to a small set of hosts. Allow up to 10 parallel
+        # keep-alive connections to each host and keep idle ones open for
+        # 30 seconds, so the next URL on that host can reuse them.
+        connector = aiohttp.TCPConnector(
+            limit=int(self.num_workers),
+            limit_per_host=10,
+            keepalive_timeout=30,
+            ttl_dns_cache=600,
+            enable_cleanup_closed=True)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers=self.headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
 
     async def __close_session(self) -> None:
         "Close the session object once it is no longer needed"
@@ -67,13 +87,15 @@ class UrlCheck:
             if num_checks < 1:
                 raise ValueError
 
+            # The connector allows as many connections as there are
+            # workers, so larger numbers actually run in parallel.
             recommendation = 4
             if 24 < num_checks < 100:
                 recommendation = 12
-            elif num_checks > 99:
+            elif 99 < num_checks <= 1000:
                 recommendation = 32
-            elif num_checks > 5000:
-                recommendation = 64
+            elif num_checks > 1000:
+                recommendation = 128
         else:
             # i.e. user set a specific number
             recommendation = int(self.num_workers)
@@ -87,11 +109,20 @@ class UrlCheck:
                            url: str) -> int:
         """The HTTP HEAD method requests the headers, but not the body of
            a page. Requesting this way reduces load on the server and
-           reduces network traffic."""
+           reduces network traffic.
+           Some servers do not allow HEAD requests. In that case fall back
+           to a full request. The body is not read.
+           Both requests follow redirects, so the status of the final
+           target decides whether a link is fine or broken."""
+        async with self.session.head(url,
+                                     allow_redirects=True,
+                                     raise_for_status=False) as response:
+            if response.status not in (403, 405):
+                return response.status
+        self.cnt['neededFullRequest'] += 1
         async with self.session.get(url,
-                                    headers=self.headers,
-                                    raise_for_status=False,
-                                    timeout=self.timeout) as response:
+                                    allow_redirects=True,
+                                    raise_for_status=False) as response:
             return response.status
 
     async def validate_url(self,
@@ -132,44 +163,48 @@ class UrlCheck:
         except Exception:
             logging.exception('Exception. URL %s', url,  exc_info=True)
 
-    async def __worker(self,
-                       name: str,
-                       queue: asyncio.Queue) -> None:
-        "Worker of the queue."
-        # DO NOT REMOVE 'while True'. Without that the queue is stopped
-        # after the first iteration.
-        while True:
-            url = await queue.get()
+    async def __bounded_validate(self,
+                                 semaphore: asyncio.Semaphore,
+                                 url: str) -> None:
+        "Validate the URL once the semaphore allows another request."
+        async with semaphore:
             await self.validate_url(url)
-            self.pbar_links.update(1)
-            queue.task_done()
+        self._pbar_delta += 1
+
+    def __flush_progress(self) -> None:
+        "Add the checks finished since the last call to the progress bar."
+        delta, self._pbar_delta = self._pbar_delta, 0
+        if delta:
+            self.pbar_links.update(delta)
+
+    async def __progress_flusher(self) -> None:
+        """Update the progress bar every 100 ms instead of once per URL.
+           Runs until cancelled."""
+        while True:
+            await asyncio.sleep(0.1)
+            self.__flush_progress()
 
     async def __distribute_work(self,
                                 urls_to_check: list) -> None:
-        "Start a queue and spawn workers to work in parallel."
-        queue: asyncio.Queue = asyncio.Queue()
-        for entry in urls_to_check:
-            queue.put_nowait(entry[0])
+        """Check all URLs concurrently with a single session. A semaphore
+           limits the number of requests in flight to the number of
+           workers."""
+        semaphore = asyncio.Semaphore(int(self.num_workers))
 
         await self.__create_session()
-
-        tasks = []
-        for i in range(int(self.num_workers)):
-            task = asyncio.create_task(self.__worker(f'worker-{i}', queue))
-            tasks.append(task)
-        await queue.join()
-
-        # Cancel worker tasks.
-        for task in tasks:
-            task.cancel()
-
-        # Close aiohttp session
-        await self.__close_session()
-
-        # Wait until all worker tasks are cancelled.
-        await asyncio.gather(*tasks, return_exceptions=True)
-
-    def check_urls(self) -> None:
+        flusher = asyncio.create_task(self.__progress_flusher())
+        try:
+            await asyncio.gather(
+                *[self.__bounded_validate(semaphore, url)
+                  for url in urls_to_check])
+        finally:
+            flusher.cancel()
+            await asyncio.gather(flusher, return_exceptions=True)
+            self.__flush_progress()
+            # Close aiohttp session
+            await self.__close_session()
+
+    async def check_urls_async(self) -> None:
         "Process all URLs that are not assumed as valid in the cache."
         urls_to_check = self.db.urls_to_check()
         if not urls_to_check:
@@ -184,6 +219,13 @@ class UrlCheck:
         print(f"{num_checks} URLs to check with {self.num_workers} workers:")
         self.pbar_links = tqdm(total=num_checks)
 
-        asyncio.run(self.__distribute_work(urls_to_check))
+        await self.__distribute_work(urls_to_check)
+        # The results are buffered:
+        self.db.flush_all()
 
         self.pbar_links.close()
+
+    def check_urls(self) -> None:
+        """Process all URLs that are not assumed as valid in the cache.
+           Blocks until all checks are done."""
+        asyncio.run(self.check_urls_async())
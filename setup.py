@@ -36,6 +36,8 @@ setuptools.setup(
                       "sqlalchemy>=1.4.21",
                       "tqdm>=4.61.2",
                       "userprovided>=0.9.2"],
+    extras_require={
+        "speedups": ['uvloop>=0.15.3; sys_platform != "win32"']},
     classifiers=[
         "Programming Language :: Python :: 3",
         "Programming Language :: Python :: 3.8",
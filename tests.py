@@ -13,23 +13,32 @@ Source: https://github.com/RuedigerVoigt/salted
 (c) 2020-2021: Released under the Apache License 2.0
 """
 
+import asyncio
+import concurrent.futures
 import logging
+import os
 import pathlib
 import re
+import sqlite3
 import tempfile
+import time
 import unittest.mock
+import urllib.parse
 
 
+import aiohttp.web
 import pyfakefs
 import pytest
 import pytest_mock
 
 import salted
 from salted import cache_reader
+from salted import command_line
 from salted import database_io
 from salted import doi_check
 from salted import err
 from salted import input_handler
+from salted import memory_instance
 from salted import parser
 from salted import url_check
 from salted import report_generator
@@ -151,6 +160,10 @@ def test_extract_links_from_html():
     assert extracted_links[0][1] == 'some text'
     assert extracted_links[1][0] == 'https://2.example.com'
     assert extracted_links[1][1] == 'another'
+    # anchors without href are skipped, empty files yield no links
+    assert my_parser.extract_links_from_html(
+        '<a name="top">Top</a><a href="/x">X</a>') == [['/x', 'X']]
+    assert my_parser.extract_links_from_html('') == []
 
 
 def test_extract_links_from_markdown():
@@ -202,6 +215,21 @@ def test_extract_mails_from_mailto():
     pass
 
 
+def test_hostname():
+    assert input_handler._hostname(
+        'https://www.Example.com/index.php?id=foo#bar') == 'www.example.com'
+    assert input_handler._hostname(
+        'http://user:pw@host.example.com:8080/x') == 'host.example.com'
+    assert input_handler._hostname('https://[::1]:80/') == '::1'
+    assert input_handler._hostname('https:///path') is None
+    assert input_handler._hostname('httpfoo') is None
+    # Same result as urlparse, including several '@' in the userinfo:
+    for url in ('http://a@b@host/', 'https://user:p@ss@Host.com:80/x?y@z',
+                'https://www.example.com/@foo', 'http://[::1]/'):
+        assert input_handler._hostname(url) == urllib.parse.urlparse(
+            url).hostname
+
+
 # fs is a fixture provided by pyfakefs
 def test_file_discovery(fs):
     fs.create_file('/fake/latex.tex')
@@ -214,21 +242,53 @@ def test_file_discovery(fs):
     fs.create_file('/fake/fake/noextension')
     fs.create_file('/fake/fake/foo.htmlandmore')
     fs.create_file('/fake/fake/fake/foo.bib')
+    fs.create_file('/fake/fake/UPPER.HTML')
+    fs.create_file('/fake/fake/.html')
     filesearch = salted.file_finder.FileFinder()
     supported_files = filesearch.find_files_by_extensions('/fake')
-    assert len(supported_files) == 7
+    assert len(supported_files) == 8
+    assert all(path.is_absolute() for path in supported_files)
     html_files = filesearch.find_html_files('/fake')
-    assert len(html_files) == 2
+    assert len(html_files) == 3
     md_files = filesearch.find_markdown_files('/fake')
     assert len(md_files) == 2
     tex_files = filesearch.find_tex_files('/fake')
     assert len(tex_files) == 2
 
 
+def test_configfile_per_working_directory(tmp_path, monkeypatch):
+    mtime = time.time()
+    for timeout in (7, 9):
+        folder = tmp_path / str(timeout)
+        folder.mkdir()
+        config = folder / salted.Salted.CONFIG_NAME
+        config.write_text(f"[BEHAVIOR]\ntimeout = {timeout}\n")
+        # Same modification time for both files:
+        os.utime(config, (mtime, mtime))
+    for timeout in (7, 9):
+        monkeypatch.chdir(tmp_path / str(timeout))
+        assert salted.Salted().timeout == timeout
+
+
+@pytest.mark.parametrize('option', ['--timeout', '--num_workers',
+                                    '--max_file_size_mb'])
+def test_cli_rejects_non_positive_numbers(option, monkeypatch):
+    monkeypatch.setattr('sys.argv', ['salted', option, '0'])
+    with pytest.raises(SystemExit):
+        command_line.main()
+
+
 def test_create_object():
     my_check = salted.Salted()
     with pytest.raises(FileNotFoundError):
         my_check.check(searchpath='non_existent.tex')
+    # A file within the path where a folder is expected:
+    with pytest.raises(FileNotFoundError):
+        my_check.check(searchpath=pathlib.Path(__file__) / 'foo.md')
+    # Other errors keep their type instead of claiming a missing file:
+    with unittest.mock.patch('os.stat', side_effect=PermissionError):
+        with pytest.raises(PermissionError):
+            my_check.check(searchpath='forbidden.md')
 
 
 def test_actual_run_html(tmp_path):
@@ -249,6 +309,20 @@ def test_actual_run_markdown(tmp_path):
     my_check.check(searchpath=(d / "test.md"))
 
 
+def test_cache_written_if_report_fails(tmp_path, monkeypatch):
+    def broken_report(*args, **kwargs):
+        raise RuntimeError('broken template')
+    monkeypatch.setattr(report_generator.ReportGenerator,
+                        'generate_report', broken_report)
+    p = tmp_path / "test.md"
+    p.write_text("No links in here.")
+    my_check = salted.Salted()
+    my_check.cache_file = tmp_path / 'cache.sqlite3'
+    with pytest.raises(RuntimeError):
+        my_check.check(searchpath=p)
+    assert my_check.cache_file.exists()
+
+
 def test_actual_run_bibtex(tmp_path):
     # side-effect: does actually call the API
     d = tmp_path / "bibtextest"
@@ -281,12 +355,47 @@ def test_throw_for_dead_link(tmp_path):
         my_check.check(searchpath=(d))
 
 
+def test_head_request_follows_redirects():
+    async def missing(request):
+        raise aiohttp.web.HTTPNotFound()
+
+    async def moved(request):
+        raise aiohttp.web.HTTPFound('/missing')
+
+    async def moved_permanently(request):
+        raise aiohttp.web.HTTPMovedPermanently('/missing')
+
+    async def check_redirects():
+        app = aiohttp.web.Application()
+        app.router.add_get('/missing', missing)
+        app.router.add_get('/moved', moved)
+        app.router.add_get('/moved-permanently', moved_permanently)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        my_test = url_check.UrlCheck('test', None, 2)
+        await my_test._UrlCheck__create_session()
+        try:
+            # A redirect to a dead target is a dead link:
+            for path in ('moved', 'moved-permanently'):
+                assert await my_test.head_request(
+                    f"http://127.0.0.1:{port}/{path}") == 404
+        finally:
+            await my_test._UrlCheck__close_session()
+            await runner.cleanup()
+    asyncio.run(check_redirects())
+
+
 def test_recommend_num_workers():
     my_test = salted.url_check.UrlCheck('test', None, 'automatic')
     # steps
     assert my_test._UrlCheck__recommend_num_workers(24) == 4
     assert my_test._UrlCheck__recommend_num_workers(99) == 12
     assert my_test._UrlCheck__recommend_num_workers(100) == 32
+    assert my_test._UrlCheck__recommend_num_workers(1000) == 32
+    assert my_test._UrlCheck__recommend_num_workers(1001) == 128
     # wrong input
     with pytest.raises(ValueError):
         my_test._UrlCheck__recommend_num_workers(0)
@@ -297,15 +406,290 @@ def test_recommend_num_workers():
     assert my_test._UrlCheck__recommend_num_workers(10000) == 10
 
 
+def test_doi_session_reuse():
+    async def get_session_twice():
+        my_test = doi_check.DoiCheck(None)
+        async with my_test:
+            first = await my_test._DoiCheck__get_session()
+            second = await my_test._DoiCheck__get_session()
+            assert first is second
+        assert first.closed
+        assert my_test.session is None
+    asyncio.run(get_session_twice())
+
+
+def test_doi_rate_limit():
+    my_test = doi_check.DoiCheck(None)
+    # 90 % of 50 requests per second, shared by all workers
+    my_test._DoiCheck__update_rate_limit(50, 1)
+    assert my_test.request_interval == pytest.approx(1 / 45)
+    with pytest.raises(ValueError):
+        my_test._DoiCheck__update_rate_limit(0, 1)
+    with pytest.raises(ValueError):
+        my_test._DoiCheck__update_rate_limit(50, 0)
+
+
 def test_scan_files(caplog):
     input_test = salted.input_handler.InputHandler(None)
     input_test.scan_files(list())
     assert 'No files to check' in caplog.text
 
 
+def test_handle_found_dois():
+    mem_instance = memory_instance.MemoryInstance()
+    db = database_io.DatabaseIO(mem_instance)
+    input_test = input_handler.InputHandler(db)
+    input_test.handle_found_dois(
+        pathlib.Path('a.bib'),
+        [[f"10.1000/{number}", 'text'] for number in range(120)])
+    assert len(db.get_dois_to_check()) == 120
+    mem_instance.tear_down_in_memory_db()
+
+
+def test_skip_large_file(tmp_path, caplog):
+    path = tmp_path / "large.md"
+    path.write_text("[link](https://www.example.com)")
+    url_list, doi_list, problem = input_handler.InputHandler(
+        None, max_file_size=10).parse_file(path)
+    assert url_list is None and doi_list is None
+    assert problem.startswith('file too large')
+    # Skipping a file is logged as a warning:
+    mem_instance = memory_instance.MemoryInstance()
+    db = database_io.DatabaseIO(mem_instance)
+    input_test = input_handler.InputHandler(db, max_file_size=10)
+    with caplog.at_level(logging.WARNING):
+        input_test.scan_files([path])
+    assert 'file too large' in caplog.text
+    assert input_test.cnt['links_found'] == 0
+    mem_instance.tear_down_in_memory_db()
+
+
+def test_scan_files_in_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(input_handler.InputHandler,
+                        'MIN_FILES_FOR_PROCESSES', 2)
+    files = list()
+    for number in range(3):
+        path = tmp_path / f"{number}.md"
+        path.write_text(f"[link](https://www.example.com/{number})")
+        files.append(path)
+    mem_instance = memory_instance.MemoryInstance()
+    db = database_io.DatabaseIO(mem_instance)
+    input_test = input_handler.InputHandler(db, use_processes=True)
+    input_test.scan_files(files)
+    assert input_test.cnt['links_found'] == 3
+    assert db.num_links_in_queue == 3
+    mem_instance.tear_down_in_memory_db()
+    # Processes are opt-in, so by default files are scanned by threads:
+    with input_handler.InputHandler(
+            None)._InputHandler__create_executor(3) as executor:
+        assert isinstance(executor, concurrent.futures.ThreadPoolExecutor)
+
+
 def test_cache_reader_no_cache_file(caplog):
     # guard condition that just returns if there is no path given to cachefile
     caplog.set_level(logging.DEBUG)
     cache_reader.CacheReader(None, 24, None)
     assert 'No path to cache file provided' in caplog.text
-    
\ No newline at end of file
+    
+
+
+def test_database_transaction():
+    mem_instance = memory_instance.MemoryInstance()
+    db = database_io.DatabaseIO(mem_instance)
+    with db.transaction():
+        db.log_error('https://www.example.com/1', 404)
+        # nested calls join the open transaction
+        with db.transaction():
+            db.log_error('https://www.example.com/2', 404)
+    assert db.count_errors() == 2
+    # everything within the failed transaction is rolled back
+    with pytest.raises(ValueError):
+        with db.transaction():
+            db.log_error('https://www.example.com/3', 410)
+            raise ValueError
+    assert db.count_errors() == 2
+    assert db.list_errors(404) == ['https://www.example.com/1',
+                                   'https://www.example.com/2']
+    assert not mem_instance.conn.in_transaction
+    mem_instance.tear_down_in_memory_db()
+
+
+def test_prepare_for_checks():
+    mem_instance = memory_instance.MemoryInstance()
+    db = database_io.DatabaseIO(mem_instance)
+    db.save_found_links([
+        ('a.md', 'example.com', 'https://example.com/1',
+         'https://example.com/1', 'cached'),
+        ('a.md', 'example.com', 'https://example.com/2',
+         'https://example.com/2', 'new'),
+        ('b.md', 'example.com', 'https://example.com/2',
+         'https://example.com/2', 'duplicate')])
+    db.log_url_is_fine('https://example.com/1')
+    db.prepare_for_checks()
+    assert db.num_links_in_queue == 2
+    assert db.urls_to_check() == ['https://example.com/2']
+    assert db.has_urls_to_check()
+    assert not db.has_dois_to_check()
+    assert not mem_instance.conn.in_transaction
+    # DOIs are case-insensitive: one check per DOI, cached in any spelling
+    db.save_found_dois([('a.bib', '10.1000/ABC', 'a'),
+                        ('b.bib', '10.1000/abc', 'b'),
+                        ('b.bib', '10.1000/Cached', 'c')])
+    db.save_valid_dois([('10.1000/CACHED', )])
+    db.del_dois_that_can_be_skipped()
+    assert db.get_dois_to_check() == ['10.1000/abc']
+    mem_instance.tear_down_in_memory_db()
+
+
+def test_report_counts_by_file():
+    mem_instance = memory_instance.MemoryInstance()
+    db = database_io.DatabaseIO(mem_instance)
+    db.save_found_links([
+        ('a.md', 'example.com', 'https://example.com/1',
+         'https://example.com/1', 'broken'),
+        ('b.md', 'example.com', 'https://example.com/1',
+         'https://example.com/1', 'broken'),
+        ('b.md', 'example.com', 'https://example.com/2',
+         'https://example.com/2', 'moved')])
+    db.log_error('https://example.com/1', 404)
+    db.log_redirect('https://example.com/2', 301)
+    db.flush_all()
+    mem_instance.generate_db_views()
+    report = report_generator.ReportGenerator(mem_instance)
+    errors = report.generate_error_list()
+    assert [(e['path'], e['num_errors']) for e in errors] == [('a.md', 1),
+                                                              ('b.md', 1)]
+    redirects = report.generate_redirect_list()
+    assert [(r['path'], r['num_redirects']) for r in redirects] == [
+        ('b.md', 1)]
+    assert report.generate_exception_list() is None
+    mem_instance.tear_down_in_memory_db()
+
+
+def test_read_file_content(tmp_path):
+    input_test = input_handler.InputHandler(None)
+    small_file = tmp_path / "small.md"
+    small_file.write_text(md_example, encoding='utf-8')
+    assert input_test.read_file_content(small_file) == md_example
+    # larger files are memory mapped
+    large_content = md_example * 200
+    large_file = tmp_path / "large.md"
+    large_file.write_text(large_content, encoding='utf-8')
+    assert large_file.stat().st_size >= input_test.MMAP_MIN_SIZE
+    assert input_test.read_file_content(large_file) == large_content
+    # universal newlines as with open() in text mode
+    crlf_file = tmp_path / "crlf.md"
+    crlf_file.write_bytes(b"[link\r\ntext](https://www.example.com)\r\n")
+    assert input_test.read_file_content(crlf_file) == (
+        "[link\ntext](https://www.example.com)\n")
+
+
+def test_read_file_content_not_utf8(tmp_path, monkeypatch):
+    monkeypatch.setattr(input_handler.locale, 'getpreferredencoding',
+                        lambda do_setlocale: 'latin-1')
+    latin1_file = tmp_path / "latin1.md"
+    latin1_file.write_bytes("[Bücher](https://www.example.com)".encode(
+        'latin-1'))
+    assert input_handler.InputHandler(None).read_file_content(
+        latin1_file) == "[Bücher](https://www.example.com)"
+
+
+def test_rewrite_path():
+    report = report_generator.ReportGenerator(None)
+    report.replace_path_by_url = {
+        'path_to_be_replaced': '/home/user/website',
+        'replace_with_url': 'https://www.example.com'}
+    assert (report.rewrite_path('/home/user/website/sub/index.html') ==
+            'https://www.example.com/sub/index.html')
+    report.replace_path_by_url['replace_with_url'] = None
+    with pytest.raises(ValueError):
+        report.rewrite_path('/home/user/website/index.html')
+
+
+def test_cache_reader_load_disk_cache(tmp_path):
+    cache_file = tmp_path / 'cache.sqlite3'
+    old_run = memory_instance.MemoryInstance()
+    cursor = old_run.get_cursor()
+    cursor.executemany(
+        "INSERT INTO validUrls VALUES (?, strftime('%s','now') - ?);",
+        [('https://www.example.com/fresh', 60),
+         ('https://www.example.com/expired', 25 * 3600)])
+    # Older versions cached DOIs in the spelling of the files:
+    cursor.executemany("INSERT INTO validDois VALUES (?, 0);",
+                       [('10.1000/1', ), ('10.1000/A', ), ('10.1000/a', )])
+    old_cache = cache_reader.CacheReader(old_run, 24, cache_file)
+    old_cache.overwrite_cache_file()
+    old_run.tear_down_in_memory_db()
+    # the temporary file was moved over the cache file
+    assert [f.name for f in tmp_path.iterdir()] == ['cache.sqlite3']
+
+    new_run = memory_instance.MemoryInstance()
+    new_cache = cache_reader.CacheReader(new_run, 24, cache_file)
+    new_cache.load_disk_cache()
+    cursor = new_run.get_cursor()
+    cursor.execute('SELECT normalizedUrl FROM validUrls;')
+    assert cursor.fetchall() == [('https://www.example.com/fresh', )]
+    cursor.execute('SELECT doi FROM validDois ORDER BY doi;')
+    assert cursor.fetchall() == [('10.1000/1', ), ('10.1000/a', )]
+    new_run.tear_down_in_memory_db()
+
+
+def test_cache_reader_update_cache_file(tmp_path):
+    cache_file = tmp_path / 'cache.sqlite3'
+    old_run = memory_instance.MemoryInstance()
+    old_run.get_cursor().executemany(
+        "INSERT INTO validUrls VALUES (?, strftime('%s','now') - ?);",
+        [('https://www.example.com/fresh', 60),
+         ('https://www.example.com/expired', 25 * 3600)])
+    cache_reader.CacheReader(old_run, 24, cache_file).overwrite_cache_file()
+    old_run.tear_down_in_memory_db()
+    # like a cache file written by an older version:
+    conn = sqlite3.connect(cache_file)
+    conn.executescript('''
+        PRAGMA journal_mode=DELETE;
+        CREATE INDEX index_timestamp ON validUrls (lastValid);''')
+    conn.close()
+
+    new_run = memory_instance.MemoryInstance()
+    new_cache = cache_reader.CacheReader(new_run, 24, cache_file)
+    new_cache.load_disk_cache()
+    db = database_io.DatabaseIO(new_run)
+    db.log_url_is_fine('https://www.example.com/new')
+    db.flush_all()
+    # only adds the new entry and removes the expired one
+    new_cache.take_snapshot()
+    # writing the snapshot does not need the in-memory database
+    new_run.tear_down_in_memory_db()
+    assert new_cache.write_snapshot()
+    conn = sqlite3.connect(cache_file)
+    rows = conn.execute(
+        'SELECT normalizedUrl FROM validUrls ORDER BY normalizedUrl;')
+    assert rows.fetchall() == [('https://www.example.com/fresh', ),
+                               ('https://www.example.com/new', )]
+    # the update switched to WAL mode and brought the indices up to date
+    assert conn.execute('PRAGMA journal_mode;').fetchone() == ('wal', )
+    assert [row[2] for row in conn.execute(
+        'PRAGMA index_info(index_timestamp);')] == ['lastValid',
+                                                    'normalizedUrl']
+    assert conn.execute('PRAGMA index_info(index_valid_doi);').fetchone()
+    conn.close()
+
+
+def test_compatibility_check_once(mocker):
+    mocker.patch.object(salted.Salted, '_compatibility_checked', False)
+    check = mocker.patch('compatibility.Check')
+    salted.Salted()
+    salted.Salted()
+    check.assert_called_once()
+
+
+def test_cache_reader_unreadable_cache(tmp_path, caplog):
+    caplog.set_level(logging.DEBUG)
+    cache_file = tmp_path / 'cache.sqlite3'
+    cache_file.write_text('not a database')
+    mem_instance = memory_instance.MemoryInstance()
+    cache = cache_reader.CacheReader(mem_instance, 24, cache_file)
+    cache.load_disk_cache()
+    assert 'Could not' in caplog.text
+    assert not mem_instance.conn.in_transaction
+    mem_instance.tear_down_in_memory_db()